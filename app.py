@@ -1,13 +1,65 @@
-from flask import Flask, render_template, redirect, url_for, request, session
+from flask import Flask, render_template, redirect, url_for, request, session, abort, jsonify, g, Response, stream_with_context
+from werkzeug.datastructures import ImmutableMultiDict
+import click
+import io
 import os
-import subprocess
+import atexit
+import threading
+import time
+import math
 import bleach
+import json
+import itertools
 from flask_wtf.csrf import CSRFProtect
-import bcrypt
+import hashing
+import hashlib
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect, text, func, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import deferred, undefer_group
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
 from datetime import datetime
+import spellcheck
+import cache
+import suggestions
+import revisions
+import writer
+import metrics
+import dictionaries
+import bulk
+import forms
+import limits
 
-def create_app():
+# Settings applied over the defaults by create_app(profile=...) or APP_PROFILE
+PROFILES = {
+    'production': dict(
+        SQLALCHEMY_TRACK_MODIFICATIONS = False,
+        SQLALCHEMY_ENGINE_OPTIONS = {'pool_size': 10, 'max_overflow': 10, 'pool_timeout': 30, 'pool_recycle': 3600, 'pool_pre_ping': True},
+        # WAL lets readers run alongside the writer, NORMAL only syncs at checkpoints
+        SQLITE_PRAGMAS = {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'mmap_size': 256 * 1024 * 1024,
+                          'cache_size': -64 * 1024, 'temp_store': 'MEMORY'},
+        # (requests, seconds) per client IP and per user, only POSTs are limited
+        RATE_LIMITS = {'login': {'ip': (30, 60), 'user': (10, 60)},
+                       'spell_check': {'ip': (120, 60), 'user': (60, 60)},
+                       'spell_check_batch': {'ip': (30, 60), 'user': (10, 60)},
+                       'spell_check_recheck': {'ip': (120, 60), 'user': (60, 60)}},
+        # The schema and admin are set up by 'flask init-db' when deploying
+        DB_AUTO_INIT = False
+    )
+}
+
+# Added to every response, built once
+SECURITY_HEADERS = (
+    ('Strict-Transport-Security', "max-age=31536000 ; includeSubDomains"),
+    ('Content-Security-Policy', "default-src 'self' ; style-src 'self' 'unsafe-inline'"),
+    ('Set-Cookie', "HTTPOnly ; Secure"),
+    ('X-FrameOptions', "DENY"),
+    ('X-XSS-Protection', "1 ; mode=block"),
+    ('X-Content-Type-Options', "nosniff"),
+)
+
+def create_app(config=None, profile=None):
     # Application setup
     app = Flask(__name__)
     app.config.update(
@@ -16,47 +68,579 @@ def create_app():
         SESSION_COOKIE_SAMESITE = 'Strict',
         PERMANENT_SESSION_LIFETIME = 600,
         SQLALCHEMY_DATABASE_URI = 'sqlite:///spellchecker.db',
-        SQLALCHEMY_TRACK_MODIFICATIONS = True
+        SQLALCHEMY_TRACK_MODIFICATIONS = True,
+        SQLALCHEMY_ENGINE_OPTIONS = {},
+        # Concurrent requests queue on SQLite's write lock, wait for it rather than fail
+        SQLITE_TIMEOUT = 30,
+        SQLITE_PRAGMAS = {},
+        # Create or upgrade the schema and seed the admin when the app starts
+        DB_AUTO_INIT = True,
+        SPELLCHECK_BACKEND = 'python',
+        SPELLCHECK_WORDLIST = 'wordlist.txt',
+        # Extra named word lists, e.g. {'fr': 'wordlist-fr.txt'}, picked with ?dictionary=
+        SPELLCHECK_DICTIONARIES = {},
+        SPELLCHECK_DEFAULT_DICTIONARY = 'default',
+        SPELLCHECK_DICTIONARY_SNAPSHOT = 'wordlist.snapshot',
+        SPELLCHECK_BINARY = './a.out',
+        SPELLCHECK_POOL_SIZE = 4,
+        SPELLCHECK_POOL_HEALTH_INTERVAL = 30,
+        SPELLCHECK_TIMEOUT = 10,
+        SPELLCHECK_BATCH_MAX_DOCUMENTS = 1000,
+        SPELLCHECK_BATCH_MAX_BYTES = 1024 * 1024,
+        SPELLCHECK_SUGGESTIONS = 5,
+        SPELLCHECK_MAX_EDIT_DISTANCE = 2,
+        SPELLCHECK_SUGGESTION_PREFIX = 7,
+        SPELLCHECK_SUGGESTION_INDEX = 'wordlist.suggest',
+        SPELLCHECK_CACHE_SIZE = 1024,
+        SPELLCHECK_CACHE_TTL = 3600,
+        SPELLCHECK_CACHE_BACKEND = 'memory',
+        SPELLCHECK_CACHE_PATH = 'spellcheck_cache.db',
+        SPELLCHECK_RELOAD_INTERVAL = 5,
+        SPELLCHECK_MAX_INPUT_BYTES = 50 * 1024 * 1024,
+        SPELLCHECK_MAX_MISSPELLED = spellcheck.MAX_MISSPELLED,
+        # Re-checked texts are stored as a delta against their parent, with the
+        # full text stored again after this many deltas in a row
+        SPELLCHECK_MAX_DELTAS = 16,
+        BCRYPT_LOG_ROUNDS = 12,
+        BCRYPT_WORKERS = 4,
+        BCRYPT_MAX_QUEUE = 64,
+        BCRYPT_TIMEOUT = 30,
+        HISTORY_PAGE_SIZE = 100,
+        IDENTITY_CACHE_SIZE = 4096,
+        IDENTITY_CACHE_TTL = 300,
+        DB_WRITE_BEHIND = True,
+        DB_WRITE_QUEUE_SIZE = 10000,
+        DB_WRITE_BATCH_SIZE = 500,
+        DB_WRITE_INTERVAL = 0.05,
+        DB_WRITE_TIMEOUT = 5,
+        PROFILE_REQUESTS = False,
+        PROFILE_THRESHOLD = 1.0,
+        PROFILE_SAMPLE_RATE = 1.0,
+        PROFILE_DIRECTORY = 'profiles',
+        IMPORT_BATCH_SIZE = 500,
+        EXPORT_BATCH_SIZE = 1000,
+        # Token buckets by endpoint, e.g. {'login': {'ip': (30, 60), 'user': (10, 60)}}
+        # allows 30 POSTs a minute from one address and 10 for one username
+        RATE_LIMITS = {},
+        RATE_LIMIT_BACKEND = 'memory',
+        RATE_LIMIT_PATH = 'rate_limits.db',
+        RATE_LIMIT_SIZE = 100000,
+        # Checks running at once, checks allowed to wait and for how long
+        SPELLCHECK_MAX_CONCURRENT = 16,
+        SPELLCHECK_MAX_WAITING = 64,
+        SPELLCHECK_WAIT_TIMEOUT = 5,
+        # Rendered GET pages kept per session state. Cached forms carry a CSRF
+        # token signed when they were rendered, keep the TTL well below
+        # WTF_CSRF_TIME_LIMIT.
+        PAGE_CACHE_SIZE = 4096,
+        PAGE_CACHE_TTL = 600,
+        # Static URLs carry a hash of the file so browsers can keep them this long
+        STATIC_MAX_AGE = 365 * 24 * 3600
     )
+    profile = profile or os.environ.get('APP_PROFILE')
+    if profile:
+        if profile not in PROFILES:
+            raise ValueError("Unknown profile %s" % profile)
+        app.config.update(PROFILES[profile])
+        if os.environ.get('DATABASE_URL'):
+            app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL'].replace('postgres://', 'postgresql://', 1)
+    if config:
+        app.config.update(config)
+    if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        options = dict(app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+        connect_args = dict(options.get('connect_args', {}), timeout=app.config['SQLITE_TIMEOUT'])
+        if make_url(app.config['SQLALCHEMY_DATABASE_URI']).database in (None, '', ':memory:'):
+            # Flask-SQLAlchemy shares one connection between threads for an in-memory database
+            connect_args['check_same_thread'] = False
+        elif options.get('pool_size'):
+            # Pooled connections are handed from one request thread to another
+            options.setdefault('poolclass', QueuePool)
+            connect_args['check_same_thread'] = False
+        options['connect_args'] = connect_args
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+    # Oversized documents are refused before anything reads the body, CSRF
+    # protection included. Werkzeug would read a body without a length to the
+    # end, so one is required.
+    @app.before_request
+    def limit_input():
+        if request.endpoint in ('spell_check', 'spell_check_recheck') and request.method == 'POST':
+            if request.content_length is None:
+                abort(411)
+            if request.content_length > app.config['SPELLCHECK_MAX_INPUT_BYTES']:
+                abort(413)
+
     csrf = CSRFProtect(app)
+
+    # Request, stage and query timings, served to admins at /metrics
+    app_metrics = metrics.Metrics()
+    app_metrics.describe('http_requests_total', "Requests handled by route, method and status")
+    app_metrics.describe('http_request_duration_seconds', "Request handling time by route, method and status")
+    app_metrics.describe('stage_duration_seconds', "Time spent in each stage of request handling")
+    app_metrics.describe('db_query_duration_seconds', "SQL statement execution time by statement type")
+    app.extensions['metrics'] = app_metrics
+    profiler = metrics.Profiler(app.config['PROFILE_DIRECTORY'], app.config['PROFILE_THRESHOLD'],
+                                app.config['PROFILE_SAMPLE_RATE'], app.config['PROFILE_REQUESTS'])
+    app.extensions['profiler'] = profiler
+
+    def stage(name):
+        return app_metrics.timer('stage_duration_seconds', stage=name)
+
+    def clean(value):
+        with stage('bleach'):
+            return bleach.clean(value)
+
+    def escape_text(value):
+        with stage('escape'):
+            return forms.escape(value)
+
+    def read_text_field(field):
+        # Reads a urlencoded form a chunk at a time, escaping the field as it
+        # arrives, so neither the raw text nor bleach's copies of it are held.
+        # The other fields go to request.form for CSRF protection and the
+        # dictionary choice.
+        if request.mimetype != 'application/x-www-form-urlencoded':
+            protect_form()
+            if field not in request.form:
+                abort(400)
+            return escape_text(request.form[field])
+        pieces = []
+        first = None
+        others = {}
+        escaper = forms.Escaper()
+        with stage('escape'):
+            try:
+                for number, name, text in forms.read_urlencoded(request.stream):
+                    if name != field:
+                        others.setdefault(number, (name, []))[1].append(text)
+                    elif first in (None, number):
+                        # Later fields with the same name are ignored like request.form does
+                        first = number
+                        pieces.append(escaper.escape(text))
+            except ValueError:
+                abort(400)
+            pieces.append(escaper.escape('', final=True))
+        request.form = ImmutableMultiDict([(name, ''.join(texts)) for number, (name, texts) in sorted(others.items())])
+        protect_form()
+        if first is None:
+            abort(400)
+        return ''.join(pieces)
+
+    def protect_form():
+        # For views exempt from CSRFProtect because they read the body themselves
+        if app.config['WTF_CSRF_ENABLED'] and app.config['WTF_CSRF_CHECK_DEFAULT']:
+            csrf.protect()
+
+    def render(template, **context):
+        with stage('template'):
+            return render_template(template, **context)
+
+    page_cache = cache.ResultCache(app.config['PAGE_CACHE_SIZE'], app.config['PAGE_CACHE_TTL'])
+    app.extensions['page_cache'] = page_cache
+    app_metrics.gauge('page_cache_hits', lambda: page_cache.hits, "Pages served from the page cache")
+    app_metrics.gauge('page_cache_misses', lambda: page_cache.misses, "Pages rendered for the page cache")
+
+    def render_page(template, form=False, **context):
+        # GET pages that only depend on who is logged in. They are rendered
+        # once per login state, or per session for pages with a form since
+        # those embed the session's CSRF token, and answered with a 304 when
+        # the browser already has them.
+        if request.method != 'GET' or not app.config['PAGE_CACHE_SIZE'] or (form and 'csrf_token' not in session):
+            return render(template, **context)
+        identity = current_identity()
+        key = (template, request.path, identity is not None, is_admin(identity),
+               session['csrf_token'] if form else None, repr(sorted(context.items())))
+        page = page_cache.get(key)
+        if page is None:
+            body = render(template, **context)
+            page = (body, hashlib.sha256(body.encode('utf-8')).hexdigest())
+            page_cache.set(key, page)
+        response = Response(page[0], mimetype='text/html')
+        response.set_etag(page[1])
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+    # Content hashes of static files by name, refreshed when a file changes
+    static_hashes = {}
+
+    def static_hash(filename):
+        path = os.path.join(app.static_folder, filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        cached = static_hashes.get(filename)
+        if cached is None or cached[0] != (stat.st_size, stat.st_mtime_ns):
+            with open(path, 'rb') as fo:
+                cached = static_hashes[filename] = ((stat.st_size, stat.st_mtime_ns), hashlib.sha256(fo.read()).hexdigest()[:16])
+        return cached[1]
+
+    @app.url_defaults
+    def static_version(endpoint, values):
+        if endpoint == 'static' and 'v' not in values and values.get('filename'):
+            version = static_hash(values['filename'])
+            if version:
+                values['v'] = version
+
+    @app.after_request
+    def cache_static(response):
+        # A hashed URL never changes, an old or missing hash is revalidated as before
+        if request.endpoint == 'static' and response.status_code == 200 and request.args.get('v') and \
+                request.args['v'] == static_hash(request.view_args['filename']):
+            response.cache_control.public = True
+            response.cache_control.max_age = app.config['STATIC_MAX_AGE']
+            response.cache_control.immutable = True
+            response.cache_control.no_cache = None
+        return response
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+        g.request_profile = profiler.start()
+
+    @app.after_request
+    def record_request(response):
+        if 'request_start' not in g:
+            return response
+        elapsed = time.perf_counter() - g.request_start
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        app_metrics.increment('http_requests_total', method=request.method, route=route, status=response.status_code)
+        app_metrics.observe('http_request_duration_seconds', elapsed, method=request.method, route=route, status=response.status_code)
+        if g.request_profile is not None:
+            path = profiler.stop(g.request_profile, elapsed, request.endpoint or 'unmatched')
+            if path:
+                app.logger.warning("Slow request %s %s took %.3fs, profile saved to %s", request.method, request.path, elapsed, path)
+        return response
+
+    # Password hashing runs on a bounded pool, requests beyond its queue get a 503
+    hashing_pool = hashing.HashingPool(app.config['BCRYPT_WORKERS'], app.config['BCRYPT_MAX_QUEUE'], app.config['BCRYPT_TIMEOUT'])
+    app.extensions['hashing_pool'] = hashing_pool
+
+    @app.errorhandler(hashing.HashingBusy)
+    @app.errorhandler(writer.WriterBusy)
+    @app.errorhandler(limits.ConcurrencyBusy)
+    def hashing_busy(error):
+        return "Server busy, please try again later.", 503, {'Retry-After': '1'}
+
+    # Rate limits and a cap on concurrent checks, rejected requests fail fast
+    if app.config['RATE_LIMIT_BACKEND'] == 'sqlite':
+        rate_limiter = limits.SqliteRateLimiter(app.config['RATE_LIMIT_PATH'], app.config['RATE_LIMIT_SIZE'])
+    else:
+        rate_limiter = limits.RateLimiter(app.config['RATE_LIMIT_SIZE'])
+    app.extensions['rate_limiter'] = rate_limiter
+    check_limit = limits.ConcurrencyLimit(app.config['SPELLCHECK_MAX_CONCURRENT'], app.config['SPELLCHECK_MAX_WAITING'],
+                                          app.config['SPELLCHECK_WAIT_TIMEOUT'])
+    app.extensions['check_limit'] = check_limit
+    app_metrics.describe('rate_limited_total', "Requests rejected by a rate limit by endpoint and scope")
+    app_metrics.gauge('spellcheck_active', lambda: check_limit.active, "Spell checks running")
+
+    def rate_limit_keys():
+        # Logins are limited by the username tried, everything else by the logged in user
+        keys = {'ip': request.remote_addr}
+        if request.endpoint == 'login':
+            keys['user'] = request.form.get('uname')
+        else:
+            identity = current_identity()
+            keys['user'] = identity[0] if identity else None
+        return keys
+
+    @app.before_request
+    def admit_request():
+        if request.method != 'POST':
+            return
+        route_limits = app.config['RATE_LIMITS'].get(request.endpoint)
+        if route_limits:
+            keys = rate_limit_keys()
+            for scope, (count, seconds) in sorted(route_limits.items()):
+                if keys.get(scope) is not None:
+                    try:
+                        rate_limiter.take('%s:%s:%s' % (request.endpoint, scope, keys[scope]), count, count / seconds)
+                    except limits.RateLimited:
+                        app_metrics.increment('rate_limited_total', endpoint=request.endpoint, scope=scope)
+                        raise
+        if request.endpoint in ('spell_check', 'spell_check_batch', 'spell_check_recheck'):
+            check_limit.acquire()
+            g.check_slot = True
+
+    @app.teardown_request
+    def release_check_slot(error):
+        if g.pop('check_slot', False):
+            check_limit.release()
+
+    @app.errorhandler(limits.RateLimited)
+    def rate_limited(error):
+        return "Too many requests, please try again later.", 429, {'Retry-After': str(max(1, int(math.ceil(error.retry_after))))}
+
+    # Spell checker setup (dictionaries are loaded once and shared by all requests)
+    def dictionary_sources():
+        # The default word list plus any named ones, snapshots and suggestion
+        # indexes of named word lists are kept next to them
+        sources = {app.config['SPELLCHECK_DEFAULT_DICTIONARY']: (app.config['SPELLCHECK_WORDLIST'], app.config['SPELLCHECK_DICTIONARY_SNAPSHOT'],
+                                                                  app.config['SPELLCHECK_SUGGESTION_INDEX'])}
+        for name, wordlist in app.config['SPELLCHECK_DICTIONARIES'].items():
+            base = os.path.splitext(wordlist)[0]
+            sources[name] = (wordlist, base + '.snapshot', base + '.suggest')
+        return sources
+
+    def load_checker(wordlist, snapshot, suggestion_path):
+        dictionary = spellcheck.load_dictionary(wordlist, snapshot)
+        suggestion_index = None
+        if app.config['SPELLCHECK_SUGGESTIONS']:
+            # Built or mapped on the first suggestion, not at startup
+            suggestion_index = suggestions.LazySuggestionIndex(suggestion_path, dictionary,
+                                                               app.config['SPELLCHECK_MAX_EDIT_DISTANCE'],
+                                                               app.config['SPELLCHECK_SUGGESTION_PREFIX'])
+        return dictionary, suggestion_index
+
+    registry = dictionaries.DictionaryRegistry(load_checker)
+    registry.update(dictionary_sources())
+    app.extensions['dictionaries'] = registry
+
+    result_cache = None
+    if app.config['SPELLCHECK_CACHE_SIZE']:
+        if app.config['SPELLCHECK_CACHE_BACKEND'] == 'sqlite':
+            result_cache = cache.SqliteResultCache(app.config['SPELLCHECK_CACHE_PATH'], app.config['SPELLCHECK_CACHE_SIZE'], app.config['SPELLCHECK_CACHE_TTL'])
+        else:
+            result_cache = cache.ResultCache(app.config['SPELLCHECK_CACHE_SIZE'], app.config['SPELLCHECK_CACHE_TTL'])
+    app.extensions['spellcheck_cache'] = result_cache
+    if result_cache is not None:
+        app_metrics.gauge('spellcheck_cache_hits', lambda: result_cache.hits, "Spell check results served from the cache")
+        app_metrics.gauge('spellcheck_cache_misses', lambda: result_cache.misses, "Spell checks that missed the cache")
+
+    pool_lock = threading.Lock()
+    checker_pools = {}
+    app.extensions['checker_pools'] = checker_pools
+
+    def get_pool(entry):
+        # Worker processes for a dictionary are only started once the pool backend uses it
+        with pool_lock:
+            if entry.name not in checker_pools:
+                pool = spellcheck.WorkerPool(spellcheck.worker_command(entry.wordlist, entry.snapshot),
+                                             size=app.config['SPELLCHECK_POOL_SIZE'],
+                                             timeout=app.config['SPELLCHECK_TIMEOUT'],
+                                             health_interval=app.config['SPELLCHECK_POOL_HEALTH_INTERVAL'])
+                atexit.register(pool.close)
+                checker_pools[entry.name] = pool
+            return checker_pools[entry.name]
+
+    def run_spellcheck(text, entry):
+        backend = app.config['SPELLCHECK_BACKEND']
+        if backend == 'binary':
+            timings = {}
+            misspelled = spellcheck.check_text_binary(text, app.config['SPELLCHECK_BINARY'], entry.wordlist, timings)
+            app_metrics.observe('stage_duration_seconds', timings['input'], stage='checker_input')
+            app_metrics.observe('stage_duration_seconds', timings['binary'], stage='checker_binary')
+            return misspelled
+        if backend == 'pool':
+            try:
+                with stage('checker_pool'):
+                    return get_pool(entry).check_text(text)
+            except spellcheck.CheckerError:
+                abort(503)
+        with stage('checker'):
+            return spellcheck.check_text(text, entry.dictionary, app.config['SPELLCHECK_MAX_MISSPELLED'])
+
+    def suggest_corrections(misspelled, entry):
+        corrections = {}
+        suggestion_index = entry.suggestion_index
+        if suggestion_index:
+            for word in misspelled:
+                if word not in corrections:
+                    corrections[word] = suggestion_index.suggest(word, app.config['SPELLCHECK_SUGGESTIONS'])
+        return corrections
+
+    def cached_result(textout, entry):
+        # Results are cached by content and dictionary version
+        key = cache.cache_key(textout, entry.dictionary.version)
+        return key, result_cache.get(key) if result_cache is not None else None
+
+    def store_result(key, misspelled, entry, suggest=True):
+        # Results checked without suggestions are cached with None in their
+        # place and get them when a page needs them
+        corrections = None
+        if suggest:
+            with stage('suggestions'):
+                corrections = suggest_corrections(misspelled, entry)
+        result = [misspelled, corrections]
+        if result_cache is not None:
+            result_cache.set(key, result)
+        return result
+
+    def check_and_suggest(textout, entry):
+        key, result = cached_result(textout, entry)
+        if result is None:
+            result = store_result(key, run_spellcheck(textout, entry), entry)
+        elif result[1] is None:
+            result = store_result(key, result[0], entry)
+        return result
+
+    def check_only(textout, entry):
+        # Misspelled words without suggestions, for callers that drop them
+        key, result = cached_result(textout, entry)
+        if result is None:
+            result = store_result(key, run_spellcheck(textout, entry), entry, suggest=False)
+        return result[0]
+
+    def select_dictionary():
+        # The dictionary picked by the request, None when it is not known
+        return registry.get(request.values.get('dictionary') or app.config['SPELLCHECK_DEFAULT_DICTIONARY'])
+
+    reload_lock = threading.Lock()
+    reload_state = {'checked': time.monotonic(), 'thread': None}
+    app.extensions['dictionary_reload'] = reload_state
+
+    def reload_dictionaries():
+        # Swap in changed word lists and drop everything derived from the old ones
+        changed = registry.update(dictionary_sources())
+        if changed and result_cache is not None:
+            result_cache.clear()
+        for name in changed:
+            with pool_lock:
+                pool = checker_pools.pop(name, None)
+            if pool:
+                pool.close()
+
+    @app.before_request
+    def check_dictionary():
+        # Loading a changed word list takes seconds, so it happens on a thread
+        # of its own while requests keep using the current entries
+        interval = app.config['SPELLCHECK_RELOAD_INTERVAL']
+        if interval and time.monotonic() - reload_state['checked'] >= interval and reload_lock.acquire(False):
+            reload_state['checked'] = time.monotonic()
+            reload_state['thread'] = threading.Thread(target=reload_in_background, name='dictionary-reload', daemon=True)
+            reload_state['thread'].start()
+
+    def reload_in_background():
+        try:
+            reload_dictionaries()
+        except Exception:
+            app.logger.exception("Could not reload the dictionaries")
+        finally:
+            reload_state['checked'] = time.monotonic()
+            reload_lock.release()
     
     # Database setup
     db = SQLAlchemy(app)
+
+    @event.listens_for(db.engine, 'before_cursor_execute')
+    def start_query_timer(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(db.engine, 'after_cursor_execute')
+    def stop_query_timer(connection, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - connection.info['query_start'].pop()
+        app_metrics.observe('db_query_duration_seconds', elapsed, statement=statement.split(None, 1)[0].upper())
+
+    if app.config['SQLITE_PRAGMAS'] and db.engine.dialect.name == 'sqlite':
+        @event.listens_for(db.engine, 'connect')
+        def set_sqlite_pragmas(connection, record):
+            cursor = connection.cursor()
+            for name, value in app.config['SQLITE_PRAGMAS'].items():
+                cursor.execute('PRAGMA %s = %s' % (name, value))
+            cursor.close()
     
     class User(db.Model):
         __tablename__ = 'user'
         id = db.Column(db.Integer, primary_key=True)
-        username = db.Column(db.String(100), nullable=False)
+        username = db.Column(db.String(100), nullable=False, unique=True, index=True)
         password = db.Column(db.String(100), nullable=False)
         twofa = db.Column(db.String(100), nullable=True)
+        role = db.Column(db.String(20), nullable=True, default='user')
 
     class Query(db.Model):
         __tablename__ = 'query'
         id = db.Column(db.Integer, primary_key=True)
-        uid = db.Column(db.Integer, db.ForeignKey('user.id'))
+        uid = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
         user = db.relationship(User)
-        textout = db.Column(db.Text, nullable=False)
-        misspelled = db.Column(db.Text, nullable=True)
+        # The submitted text is only loaded when a single query is opened
+        textout = deferred(db.Column(db.Text, nullable=False), group='content')
+        misspelled = deferred(db.Column(db.Text, nullable=True), group='content')
+        suggestions = deferred(db.Column(db.Text, nullable=True), group='content')
+        # Name and version of the dictionary the text was checked against
+        dictionary = db.Column(db.String(64), nullable=True)
+        dictionary_version = db.Column(db.String(64), nullable=True)
+        # A re-check of an earlier query. When delta is set textout is empty
+        # and the text is the parent's with the delta applied.
+        parent_id = db.Column(db.Integer, db.ForeignKey('query.id'), nullable=True)
+        delta = deferred(db.Column(db.Text, nullable=True), group='content')
 
     class Log(db.Model):
         __tablename__ = 'log'
+        # Covers lookups by user and finding a user's latest log
+        __table_args__ = (db.Index('ix_log_uid_id', 'uid', 'id'),)
         id = db.Column(db.Integer, primary_key=True)
         uid = db.Column(db.Integer, db.ForeignKey('user.id'))
         user = db.relationship(User)
         login = db.Column(db.DateTime, nullable=False, default=datetime.utcnow())
         logout = db.Column(db.DateTime, nullable=True, default=None)
 
-    db.create_all()
+    def upgrade_schema():
+        # Add columns introduced after an existing database was created
+        inspector = inspect(db.engine)
+        for table in db.Model.metadata.sorted_tables:
+            existing = set(column['name'] for column in inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name not in existing:
+                    db.session.execute(text('ALTER TABLE %s ADD COLUMN %s %s' % (table.name, column.name, column.type.compile(db.engine.dialect))))
+        db.session.commit()
+        # Add indexes introduced after an existing database was created
+        for table in db.Model.metadata.sorted_tables:
+            existing = set(index['name'] for index in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in existing:
+                    try:
+                        index.create(bind=db.engine)
+                    except IntegrityError:
+                        app.logger.warning("Could not create unique index %s, %s has duplicate rows", index.name, table.name)
+
+    # Query and Log rows are written in batches by a background thread, or
+    # committed straight away when DB_WRITE_BEHIND is off
+    def write_rows(rows):
+        with stage('db_write'):
+            for model, group in itertools.groupby(rows, key=lambda row: row[0]):
+                db.session.bulk_insert_mappings(model, [row[1] for row in group])
+            db.session.commit()
+
+    def write_rows_behind(rows):
+        with app.app_context():
+            write_rows(rows)
+
+    write_queue = None
+    if app.config['DB_WRITE_BEHIND']:
+        write_queue = writer.WriteBehindQueue(write_rows_behind, app.config['DB_WRITE_QUEUE_SIZE'], app.config['DB_WRITE_BATCH_SIZE'],
+                                              app.config['DB_WRITE_INTERVAL'], app.config['DB_WRITE_TIMEOUT'])
+        atexit.register(write_queue.close)
+    app.extensions['write_queue'] = write_queue
+    if write_queue is not None:
+        app_metrics.gauge('db_write_queue_pending', lambda: write_queue.pending, "Queued rows not yet written")
+
+    def queue_rows(rows):
+        if write_queue is None:
+            write_rows(rows)
+        else:
+            write_queue.put_many(rows)
+
+    def flush_writes():
+        # Pages reading Query or Log rows first wait for the queued ones, and
+        # get a 503 rather than stale rows when the writer falls behind
+        if write_queue is not None and not write_queue.flush(app.config['DB_WRITE_TIMEOUT']):
+            app.logger.warning("Queued rows were not written within %ss", app.config['DB_WRITE_TIMEOUT'])
+            raise writer.WriterBusy()
     
     # Database functions
     def register_with_user_info(uname, pword, twofa):
         user = db.session.query(User).filter(User.username == uname).first()
         if not user:
-            hashed_pword = bcrypt.hashpw(pword.encode('utf8'), bcrypt.gensalt())
-            hashed_twofa = bcrypt.hashpw(twofa.encode('utf8'), bcrypt.gensalt())
+            with stage('bcrypt'):
+                hashed_pword, hashed_twofa = hashing_pool.hashpw_many([pword.encode('utf8'), twofa.encode('utf8')], app.config['BCRYPT_LOG_ROUNDS'])
             new_user = User(username=uname, password=hashed_pword, twofa=hashed_twofa)
             db.session.add(new_user)
-            db.session.commit()
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # Someone registered the same name in the meantime
+                db.session.rollback()
+                return 1
             return 0
         else:
             return 1
@@ -64,59 +648,235 @@ def create_app():
     def login_with_user_info(uname, pword, twofa):
         user = db.session.query(User).filter(User.username == uname).first()
         if not user:
-            return 2
-        if bcrypt.checkpw(pword.encode('utf8'), user.password) == False:
-            return 2
-        if bcrypt.checkpw(twofa.encode('utf8'), user.twofa) == False:
-            return 1
-        new_log = Log(uid=user.id)
-        db.session.add(new_log)
-        db.session.commit()
-        return 0
+            return 2, None
+        with stage('bcrypt'):
+            if hashing_pool.checkpw(pword.encode('utf8'), user.password) == False:
+                return 2, None
+            if hashing_pool.checkpw(twofa.encode('utf8'), user.twofa) == False:
+                return 1, None
+        # Move hashes made with an older work factor to the current one
+        if hashing.hash_rounds(user.password) != app.config['BCRYPT_LOG_ROUNDS']:
+            with stage('bcrypt'):
+                user.password, user.twofa = hashing_pool.hashpw_many([pword.encode('utf8'), twofa.encode('utf8')], app.config['BCRYPT_LOG_ROUNDS'])
+            db.session.commit()
+        identity = remember_identity(user)
+        queue_rows([(Log, dict(uid=user.id, login=datetime.utcnow()))])
+        return 0, (user.id,) + identity
 
-    def add_spellcheck(uname, textout, misspelled):
-        user = db.session.query(User).filter(User.username == uname).first()
-        if user:
-            new_query = Query(uid=user.id, textout=textout, misspelled=misspelled)
-            db.session.add(new_query)
+    def add_spellcheck(uid, textout, misspelled, entry, corrections=None):
+        queue_rows([(Query, dict(uid=uid, textout=textout, misspelled=misspelled,
+                                 suggestions=json.dumps(corrections) if corrections else None,
+                                 dictionary=entry.name, dictionary_version=entry.dictionary.version))])
+
+    def add_spellchecks(uid, results, entry):
+        queue_rows([(Query, dict(uid=uid, textout=textout, misspelled=misspelled,
+                                 dictionary=entry.name, dictionary_version=entry.dictionary.version)) for textout, misspelled in results])
+
+    # Logged in users are identified by the id and role saved in their session
+    # at login. The cache maps ids to (username, role) so role changes can be
+    # picked up by forgetting the id instead of querying on every request.
+    identity_cache = cache.ResultCache(app.config['IDENTITY_CACHE_SIZE'], app.config['IDENTITY_CACHE_TTL'])
+    app.extensions['identity_cache'] = identity_cache
+
+    def remember_identity(user):
+        identity = (user.username, user.role or 'user')
+        identity_cache.set(user.id, identity)
+        return identity
+
+    def forget_identity(uid):
+        identity_cache.delete(uid)
+
+    def current_identity():
+        # Returns (uid, username, role) for the logged in user, or None
+        if 'username' not in session:
+            return None
+        uid = session.get('uid')
+        identity = identity_cache.get(uid) if uid is not None else None
+        if identity is None:
+            # Sessions from before ids were stored, or a forgotten identity
+            if uid is not None:
+                user = db.session.get(User, uid)
+            else:
+                user = db.session.query(User).filter(User.username == session['username']).first()
+            if user is None:
+                return None
+            identity = remember_identity(user)
+            session['uid'], session['role'] = user.id, identity[1]
+        return (session['uid'],) + identity
+
+    def is_admin(identity):
+        return identity is not None and identity[2] == 'admin'
+
+    @app.context_processor
+    def inject_identity():
+        identity = current_identity()
+        return dict(is_admin=is_admin(identity))
+
+    def user_id(uname):
+        return db.session.query(User.id).filter(User.username == uname).scalar()
+
+    def page_after():
+        return request.args.get('after', 0, type=int)
+
+    def query_page(uid, after):
+        # Keyset pagination on the query id, selecting only what history.html shows
+        page_size = app.config['HISTORY_PAGE_SIZE']
+        rows = db.session.query(Query.id).filter(Query.uid == uid, Query.id > after).order_by(Query.id).limit(page_size + 1).all()
+        count = db.session.query(func.count(Query.id)).filter(Query.uid == uid).scalar()
+        return rows[:page_size], count, rows[page_size - 1].id if len(rows) > page_size else None
+
+    def log_page(uid, after):
+        page_size = app.config['HISTORY_PAGE_SIZE']
+        rows = db.session.query(Log.id, Log.login, Log.logout).filter(Log.uid == uid, Log.id > after).order_by(Log.id).limit(page_size + 1).all()
+        return rows[:page_size], rows[page_size - 1].id if len(rows) > page_size else None
+
+    def import_users(rows):
+        # Registers (username, password, twofa) rows a batch at a time, hashing
+        # on the pool and inserting each batch in one transaction. Rows with a
+        # taken or repeated username or a missing field are skipped. A row that
+        # cannot be read stops the import, the rows before it stay imported and
+        # the error is returned with the counts.
+        imported = skipped = 0
+        error = None
+        rows = iter(rows)
+        while error is None:
+            batch = []
+            try:
+                for row in itertools.islice(rows, app.config['IMPORT_BATCH_SIZE']):
+                    batch.append(row)
+            except ValueError as e:
+                error = e
+            if not batch:
+                break
+            batch = [tuple(clean(value) for value in row) for row in batch]
+            taken = set(name for (name,) in db.session.query(User.username).filter(User.username.in_([row[0] for row in batch])))
+            users = []
+            for uname, pword, twofa in batch:
+                if not (uname and pword and twofa) or uname in taken:
+                    skipped += 1
+                    continue
+                taken.add(uname)
+                users.append((uname, pword, twofa))
+            with stage('bcrypt'):
+                hashes = list(hashing_pool.hashpw_stream([value.encode('utf8') for user in users for value in user[1:]], app.config['BCRYPT_LOG_ROUNDS']))
+            db.session.bulk_insert_mappings(User, [dict(username=uname, password=hashes[2 * i], twofa=hashes[2 * i + 1], role='user')
+                                                   for i, (uname, pword, twofa) in enumerate(users)])
             db.session.commit()
+            imported += len(users)
+        return imported, skipped, error
+
+    def export_rows(kind, uid=None):
+        # Selected columns only, fetched in batches through a server side cursor
+        if kind == 'queries':
+            columns = [Query.id, User.username, Query.textout, Query.misspelled, Query.dictionary, Query.dictionary_version]
+            rows = db.session.query(*columns, Query.delta).join(User, Query.uid == User.id).order_by(Query.id)
+            if uid is not None:
+                rows = rows.filter(Query.uid == uid)
+            rows = rows.execution_options(stream_results=True).yield_per(app.config['EXPORT_BATCH_SIZE'])
+            # Texts stored as deltas are rebuilt
+            rows = (row[:2] + (query_text(load_query(row[0]))[0],) + row[3:-1] if row[-1] is not None else row[:-1] for row in rows)
+            return [column.key for column in columns], rows
+        columns = [Log.id, User.username, Log.login, Log.logout]
+        rows = db.session.query(*columns).join(User, Log.uid == User.id).order_by(Log.id)
+        if uid is not None:
+            rows = rows.filter(Log.uid == uid)
+        return [column.key for column in columns], rows.execution_options(stream_results=True).yield_per(app.config['EXPORT_BATCH_SIZE'])
+
+    def load_query(query_id):
+        return db.session.query(Query).options(undefer_group('content')).filter(Query.id == query_id).first()
+
+    def query_text(userquery):
+        # Returns the text of a query and the number of deltas applied to get it
+        deltas = []
+        while userquery.delta is not None:
+            deltas.append(json.loads(userquery.delta))
+            userquery = load_query(userquery.parent_id)
+        textout = userquery.textout
+        for delta in reversed(deltas):
+            textout = revisions.apply_delta(textout, delta)
+        return textout, len(deltas)
+
+    def add_recheck(uid, parent, parent_text, depth, textout, misspelled, entry, corrections):
+        # Saved straight away as the caller needs the new id. The text is only
+        # stored in full when a delta would not be smaller or the chain of
+        # deltas is already long.
+        delta = json.dumps(revisions.text_delta(parent_text, textout), separators=(',', ':'))
+        if depth >= app.config['SPELLCHECK_MAX_DELTAS'] or len(delta) >= len(textout):
+            delta = None
+        userquery = Query(uid=uid, textout='' if delta else textout, delta=delta, parent_id=parent.id,
+                          misspelled=", ".join(misspelled), suggestions=json.dumps(corrections) if corrections else None,
+                          dictionary=entry.name, dictionary_version=entry.dictionary.version)
+        with stage('db_write'):
+            db.session.add(userquery)
+            db.session.commit()
+        return userquery.id
+
+    @app.cli.command('import-users', help="Register users from a CSV file with a username,password,twofa header or from JSON lines.")
+    @click.argument('source', type=click.File('r'))
+    @click.option('--format', 'format', type=click.Choice(bulk.FORMATS), help="Defaults to the file extension.")
+    def import_users_command(source, format):
+        format = format or ('csv' if source.name.endswith('.csv') else 'jsonl')
+        imported, skipped, error = import_users(bulk.read_users(source, format))
+        click.echo("Imported %d users, skipped %d" % (imported, skipped))
+        if error is not None:
+            raise click.ClickException("Stopped at %s" % error)
 
     def create_admin():
-        register_with_user_info("admin", "Administrator@1", "12345678901")
-    create_admin()
+        # Only hashes the password when the admin does not exist yet
+        admin = db.session.query(User).filter(User.username == "admin").first()
+        if admin is None:
+            register_with_user_info("admin", "Administrator@1", "12345678901")
+            admin = db.session.query(User).filter(User.username == "admin").first()
+        if admin.role != 'admin':
+            admin.role = 'admin'
+            db.session.commit()
+            forget_identity(admin.id)
+
+    def init_db():
+        db.create_all()
+        upgrade_schema()
+        create_admin()
+
+    @app.cli.command('init-db', help="Create or upgrade the database schema and add the admin user.")
+    def init_db_command():
+        init_db()
+        click.echo("Initialized the database")
+
+    if app.config['DB_AUTO_INIT']:
+        init_db()
 
     # Web application pages
     @app.route("/")
     def home():
-        return render_template("home.html")
+        return render_page("home.html")
 
     @app.route("/register", methods = ['GET', 'POST'])
     def register():
         success = ""
         if 'username' not in session:
             if request.method == 'POST':
-                uname = bleach.clean(request.form['uname'])
-                pword = bleach.clean(request.form['pword'])
-                twofa = bleach.clean(request.form['2fa'])
+                uname = clean(request.form['uname'])
+                pword = clean(request.form['pword'])
+                twofa = clean(request.form['2fa'])
                 status = register_with_user_info(uname, pword, twofa)
                 if status == 0:
                     success = "Registration Success!"
                 else:
                     success = "Registration Failure!"
-            return render_template("register.html", id = success)
+            return render_page("register.html", form=True, id = success)
         else:
             success = "Already logged in!"
-            return render_template("register.html", id = success)
+            return render_page("register.html", form=True, id = success)
 
     @app.route("/login", methods = ['GET', 'POST'])
     def login():
         result = ""
         if 'username' not in session:
             if request.method == 'POST':
-                uname = bleach.clean(request.form['uname'])
-                pword = bleach.clean(request.form['pword'])
-                twofa = bleach.clean(request.form['2fa'])
-                status = login_with_user_info(uname, pword, twofa)
+                uname = clean(request.form['uname'])
+                pword = clean(request.form['pword'])
+                twofa = clean(request.form['2fa'])
+                status, identity = login_with_user_info(uname, pword, twofa)
                 if status == 2:
                     result = "Incorrect username or password!"
                 elif status == 1:
@@ -124,93 +884,227 @@ def create_app():
                 else:
                     result = "Success!"
                     session.permanent = True
-                    session['username'] = uname
-            return render_template("login.html", id = result)
+                    session['uid'], session['username'], session['role'] = identity
+            return render_page("login.html", form=True, id = result)
         else:
             result = "Already logged in!"
-            return render_template("login.html", id = result)
+            return render_page("login.html", form=True, id = result)
 
     @app.route("/spell_check", methods = ['GET', 'POST'])
+    @csrf.exempt
     def spell_check():
-        if 'username' in session:
+        identity = current_identity()
+        if identity:
             textout = ""
             misspelled = ""
+            corrections = {}
+            if request.method == 'POST':
+                # The form is read first, its dictionary field may come after the text
+                textout = read_text_field('inputtext')
+            entry = select_dictionary()
+            if entry is None:
+                abort(400)
             if request.method == 'POST':
-                textout = bleach.clean(request.form['inputtext'])
-                with open("test.txt", "w+") as fo:
-                    fo.write(textout)
-                misspelled = subprocess.check_output(["./a.out", "test.txt", "wordlist.txt"])
-                misspelled = misspelled.decode('utf-8').strip().split('\n')
-                misspelled = ", ".join(misspelled)
-                fo.close()
-                os.remove("test.txt")
-                name = session['username']
-                add_spellcheck(name, textout, misspelled)
-            return render_template("spell_check.html", textout = textout, misspelled = misspelled)
+                words, corrections = check_and_suggest(textout, entry)
+                misspelled = ", ".join(words)
+                add_spellcheck(identity[0], textout, misspelled, entry, corrections)
+            # Only the empty form of a GET is cached
+            return render_page("spell_check.html", form=True, textout = textout, misspelled = misspelled, suggestions = corrections,
+                               dictionaries = registry.names(), dictionary = entry.name)
         else:
             return redirect(url_for("home"))
 
+    @app.route("/api/spell_check/batch", methods = ['POST'])
+    def spell_check_batch():
+        identity = current_identity()
+        if not identity:
+            return jsonify(error="Not logged in"), 401
+        if request.content_length is None or request.content_length > app.config['SPELLCHECK_BATCH_MAX_BYTES']:
+            return jsonify(error="Request too large"), 413
+        documents = request.get_json(silent=True)
+        if not isinstance(documents, list) or not all(isinstance(document, str) for document in documents):
+            return jsonify(error="Expected a JSON array of strings"), 400
+        if len(documents) > app.config['SPELLCHECK_BATCH_MAX_DOCUMENTS']:
+            return jsonify(error="Too many documents"), 413
+        entry = select_dictionary()
+        if entry is None:
+            return jsonify(error="Unknown dictionary"), 400
+        results = []
+        for document in documents:
+            textout = escape_text(document)
+            results.append((textout, check_only(textout, entry)))
+        add_spellchecks(identity[0], [(textout, ", ".join(misspelled)) for textout, misspelled in results], entry)
+        return jsonify(results=[misspelled for textout, misspelled in results])
+
+    @app.route("/api/spell_check/recheck/<int:query_id>", methods = ['POST'])
+    def spell_check_recheck(query_id):
+        # Checks an edited version of an earlier query, {"text": ...}, passing
+        # only the changed lines to the checker and storing the new version as
+        # a delta against the old one
+        identity = current_identity()
+        if not identity:
+            return jsonify(error="Not logged in"), 401
+        if request.content_length is None or request.content_length > app.config['SPELLCHECK_MAX_INPUT_BYTES']:
+            return jsonify(error="Request too large"), 413
+        document = request.get_json(silent=True)
+        if not isinstance(document, dict) or not isinstance(document.get('text'), str):
+            return jsonify(error="Expected a JSON object with a text string"), 400
+        flush_writes()
+        parent = load_query(query_id)
+        if parent is None or parent.uid != identity[0]:
+            return jsonify(error="Unknown query"), 404
+        entry = registry.get(parent.dictionary or app.config['SPELLCHECK_DEFAULT_DICTIONARY'])
+        if entry is None:
+            return jsonify(error="Unknown dictionary"), 400
+        textout = escape_text(document['text'])
+        parent_text, depth = query_text(parent)
+        key, result = cached_result(textout, entry)
+        checked = 0
+        if result is None:
+            previous = parent.misspelled.split(", ") if parent.misspelled else []
+            # Earlier results only count when they are complete and from the same word list
+            if parent.dictionary_version == entry.dictionary.version and len(previous) < app.config['SPELLCHECK_MAX_MISSPELLED']:
+                misspelled, checked = revisions.recheck(parent_text, textout, previous, lambda text: run_spellcheck(text, entry),
+                                                        app.config['SPELLCHECK_MAX_MISSPELLED'])
+            else:
+                misspelled = run_spellcheck(textout, entry)
+                checked = len(revisions.split_lines(textout))
+            result = store_result(key, misspelled, entry)
+        elif result[1] is None:
+            result = store_result(key, result[0], entry)
+        misspelled, corrections = result
+        new_id = add_recheck(identity[0], parent, parent_text, depth, textout, misspelled, entry, corrections)
+        return jsonify(id=new_id, parent=parent.id, misspelled=misspelled, suggestions=corrections, checked_lines=checked)
+
     @app.route("/logout")
     def logout():
-        if 'username' in session:
-            name = session['username']
-            userlog = db.session.query(Log).join(User, Log.uid == User.id).filter(User.username == name).order_by(Log.id.desc()).first()
+        identity = current_identity()
+        if identity:
+            flush_writes()
+            userlog = db.session.query(Log).filter(Log.uid == identity[0]).order_by(Log.id.desc()).first()
             if userlog:
                 userlog.logout = datetime.utcnow()
                 db.session.commit()
                 session.pop('username', None)
+                session.pop('uid', None)
+                session.pop('role', None)
         return redirect(url_for("home"))
 
     @app.route("/history", methods = ['GET', 'POST'])
     def history():
-        if 'username' in session:
-            name = session['username']
-            if name == 'admin':
-                history = ""
+        identity = current_identity()
+        if identity:
+            flush_writes()
+            uid, name, role = identity
+            if is_admin(identity):
+                history, numqueries, next_after = [], 0, None
                 uname = name
                 if request.method == 'POST':
-                    uname = bleach.clean(request.form['uname'])
-                    history = db.session.query(Query).join(User, Query.uid == User.id).filter(User.username == uname).all()
-                return render_template("history.html", history=history, searched=uname, name=name)
+                    uname = clean(request.form['uname'])
+                elif 'uname' in request.args:
+                    uname = clean(request.args['uname'])
+                if request.method == 'POST' or 'uname' in request.args:
+                    history, numqueries, next_after = query_page(user_id(uname), page_after())
+                return render("history.html", history=history, numqueries=numqueries, next_after=next_after, searched=uname)
             else:
-                history = db.session.query(Query).join(User, Query.uid == User.id).filter(User.username == name).all()
-                return render_template("history.html", history=history, searched=name)
+                history, numqueries, next_after = query_page(uid, page_after())
+                return render("history.html", history=history, numqueries=numqueries, next_after=next_after, searched=name)
         else:
             return redirect(url_for("home"))
 
     @app.route("/history/query<int:query_id>")
     def query(query_id):
-        if 'username' in session:
-            userquery = db.session.query(Query).join(User, Query.uid == User.id).filter(Query.id == query_id).first()
+        identity = current_identity()
+        if identity:
+            flush_writes()
+            userquery = load_query(query_id)
             if userquery:
-                name = session['username']
-                if userquery.user.username == name or name == 'admin':
-                    return render_template("query.html", userquery=userquery)
+                if userquery.uid == identity[0] or is_admin(identity):
+                    corrections = json.loads(userquery.suggestions) if userquery.suggestions else {}
+                    return render("query.html", userquery=userquery, textout=query_text(userquery)[0], suggestions=corrections)
             return redirect(url_for("history"))
         else:
             return redirect(url_for("home"))
 
     @app.route("/login_history", methods = ['GET', 'POST'])
     def login_history():
-        if 'username' in session and session['username'] == "admin":
+        if is_admin(current_identity()):
+            flush_writes()
             uname = ""
             if request.method == 'POST':
-                uname = bleach.clean(request.form['uname'])
-                userlog = db.session.query(Log).join(User, Log.uid == User.id).filter(User.username == uname).all()
+                uname = clean(request.form['uname'])
+            elif 'uname' in request.args:
+                uname = clean(request.args['uname'])
+            if uname:
+                userlog, next_after = log_page(user_id(uname), page_after())
                 if userlog:
-                    return render_template("login_history.html", userlog=userlog, uname=uname)
-            return render_template("login_history.html", uname=uname)
+                    return render("login_history.html", userlog=userlog, next_after=next_after, uname=uname)
+            return render("login_history.html", uname=uname)
         else:
             return redirect(url_for("home"))
 
+    @app.route("/admin/users/import", methods = ['POST'])
+    def users_import():
+        # Body is CSV with a header row or JSON lines, read as it arrives
+        if not is_admin(current_identity()):
+            return jsonify(error="Not allowed"), 403
+        format = request.args.get('format') or ('csv' if request.mimetype == 'text/csv' else 'jsonl')
+        if format not in bulk.FORMATS:
+            return jsonify(error="Unknown format"), 400
+        imported, skipped, error = import_users(bulk.read_users(io.TextIOWrapper(request.stream, encoding='utf-8'), format))
+        if error is not None:
+            # Earlier batches are already committed, so say how far it got
+            return jsonify(error="Could not read the user list: %s" % error, imported=imported, skipped=skipped), 400
+        return jsonify(imported=imported, skipped=skipped)
+
+    @app.route("/admin/export/<any(queries, logs):kind>")
+    def export(kind):
+        if not is_admin(current_identity()):
+            abort(403)
+        format = request.args.get('format', 'csv')
+        if format not in bulk.FORMATS:
+            abort(400)
+        uid = None
+        if request.args.get('uname'):
+            uid = user_id(clean(request.args["uname"]))
+            if uid is None:
+                abort(404)
+        flush_writes()
+        columns, rows = export_rows(kind, uid)
+        return Response(stream_with_context(bulk.format_rows(columns, rows, format)),
+                        mimetype='text/csv' if format == 'csv' else 'application/x-ndjson',
+                        headers={'Content-Disposition': 'attachment; filename=%s.%s' % (kind, format)})
+
+    @app.route("/metrics")
+    def metrics_page():
+        if not is_admin(current_identity()):
+            abort(403)
+        return app_metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+    @app.route("/metrics/profile", methods = ['GET', 'POST'])
+    def profile_settings():
+        # Turns request profiling on or off without a restart
+        if not is_admin(current_identity()):
+            abort(403)
+        if request.method == 'POST':
+            # Both numbers are read before anything changes so a bad one applies nothing
+            try:
+                threshold = float(request.form.get('threshold', profiler.threshold))
+                sample_rate = float(request.form.get('sample_rate', profiler.sample_rate))
+            except ValueError:
+                return jsonify(error="threshold and sample_rate must be numbers"), 400
+            if not (math.isfinite(threshold) and math.isfinite(sample_rate)):
+                return jsonify(error="threshold and sample_rate must be numbers"), 400
+            if 'enabled' in request.form:
+                profiler.enabled = request.form['enabled'] in ('1', 'true', 'on')
+            profiler.threshold = threshold
+            profiler.sample_rate = min(max(sample_rate, 0.0), 1.0)
+        return jsonify(enabled=profiler.enabled, threshold=profiler.threshold, sample_rate=profiler.sample_rate,
+                       directory=profiler.directory, saved=profiler.saved)
+
     @app.after_request
     def add_headers(response):
-        response.headers['Strict-Transport-Security'] = "max-age=31536000 ; includeSubDomains"
-        response.headers['Content-Security-Policy'] = "default-src 'self' ; style-src 'self' 'unsafe-inline'"
-        response.headers['Set-Cookie'] = "HTTPOnly ; Secure"
-        response.headers['X-FrameOptions'] = "DENY"
-        response.headers['X-XSS-Protection'] = "1 ; mode=block"
-        response.headers['X-Content-Type-Options'] = "nosniff"
+        response.headers.update(SECURITY_HEADERS)
         return response
 
     return app
@@ -0,0 +1,36 @@
+# Compares two result files written by routes.py --output, printing the change
+# in throughput and tail latency of every route and concurrency level.
+#
+#   python benchmarks/compare.py before.json after.json
+import argparse
+import json
+
+
+def load(path):
+    with open(path) as fo:
+        results = json.load(fo)
+    return dict(((result['route'], result['concurrency']), result) for result in results['results'])
+
+
+def change(before, after):
+    return (after - before) / before * 100 if before else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two route benchmark runs")
+    parser.add_argument("before")
+    parser.add_argument("after")
+    args = parser.parse_args()
+
+    before = load(args.before)
+    after = load(args.after)
+    for key in sorted(set(before) & set(after)):
+        old, new = before[key], after[key]
+        print("%-14s concurrency=%-4d requests/s %8.1f -> %8.1f (%+6.1f%%)  p95 %7.2fms -> %7.2fms (%+6.1f%%)  p99 %7.2fms -> %7.2fms (%+6.1f%%)" % (
+            key[0], key[1], old['throughput'], new['throughput'], change(old['throughput'], new['throughput']),
+            old['p95'] * 1000, new['p95'] * 1000, change(old['p95'], new['p95']),
+            old['p99'] * 1000, new['p99'] * 1000, change(old['p99'], new['p99'])))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# Measures the hot user lookups with and without the indexes on a database
+# seeded with a large number of rows, using the same SQL the routes issue.
+#
+#   python benchmarks/db_indexes.py --users 10000 --rows 1000000
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import create_app
+
+LOOKUPS = [
+    ("user by username", "SELECT id FROM user WHERE username = ?"),
+    ("queries of user", "SELECT query.id FROM query JOIN user ON query.uid = user.id WHERE user.username = ?"),
+    ("logs of user", "SELECT log.id FROM log JOIN user ON log.uid = user.id WHERE user.username = ?"),
+    ("latest log of user", "SELECT log.id FROM log JOIN user ON log.uid = user.id WHERE user.username = ? ORDER BY log.id DESC LIMIT 1"),
+]
+INDEXES = ["ix_user_username", "ix_query_uid", "ix_log_uid_id"]
+
+
+def seed(path, users, rows):
+    connection = sqlite3.connect(path)
+    connection.executemany("INSERT INTO user (username, password, twofa) VALUES (?, 'x', 'x')",
+                           (("user%d" % number,) for number in range(users)))
+    rng = random.Random(9163)
+    connection.executemany("INSERT INTO query (uid, textout, misspelled) VALUES (?, 'my dawg is kewl.', 'dawg, kewl')",
+                           ((rng.randint(1, users),) for _ in range(rows)))
+    connection.executemany("INSERT INTO log (uid, login) VALUES (?, '2019-11-01 00:00:00')",
+                           ((rng.randint(1, users),) for _ in range(rows)))
+    connection.commit()
+    return connection
+
+
+def measure(connection, users, samples):
+    rng = random.Random(1)
+    names = ["user%d" % rng.randrange(users) for _ in range(samples)]
+    for label, sql in LOOKUPS:
+        plan = " / ".join(row[-1] for row in connection.execute("EXPLAIN QUERY PLAN " + sql, (names[0],)))
+        latencies = []
+        for name in names:
+            start = time.perf_counter()
+            connection.execute(sql, (name,)).fetchall()
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        print("  %-20s p50=%8.3fms p99=%8.3fms  %s" % (label, latencies[len(latencies) // 2] * 1000,
+                                                      latencies[int(len(latencies) * 0.99)] * 1000, plan))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index lookup benchmark")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--samples", type=int, default=50)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+    create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path, 'BCRYPT_LOG_ROUNDS': 4})
+    start = time.perf_counter()
+    connection = seed(path, args.users, args.rows)
+    print("seeded %d users, %d queries and %d logs in %.1fs" % (args.users + 1, args.rows, args.rows, time.perf_counter() - start))
+    print("with indexes")
+    measure(connection, args.users, args.samples)
+    for index in INDEXES:
+        connection.execute("DROP INDEX %s" % index)
+    connection.commit()
+    connection.close()
+    connection = sqlite3.connect(path)
+    print("without indexes")
+    measure(connection, args.users, args.samples)
+    connection.close()
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+# Measures login throughput through the Flask test client at several levels
+# of concurrency, using a throwaway database in a temporary directory.
+#
+#   python benchmarks/login_throughput.py --users 16 --logins 64 --concurrency 1 4 16 --rounds 12
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import create_app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Login throughput benchmark")
+    parser.add_argument("--users", type=int, default=16)
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--rounds", type=int, default=12)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(directory, 'benchmark.db'),
+        'WTF_CSRF_ENABLED': False,
+        'BCRYPT_LOG_ROUNDS': args.rounds,
+        'BCRYPT_WORKERS': args.workers,
+        'BCRYPT_MAX_QUEUE': args.logins * 2,
+    })
+    client = app.test_client()
+    for number in range(args.users):
+        client.post('/register', data={'uname': "user%d" % number, 'pword': "password", '2fa': "6316827788"})
+
+    def login(number):
+        start = time.perf_counter()
+        result = app.test_client().post('/login', data={'uname': "user%d" % (number % args.users), 'pword': "password", '2fa': "6316827788"})
+        assert b'Success!' in result.data, result.status
+        return time.perf_counter() - start
+
+    print("rounds=%d workers=%d" % (args.rounds, args.workers))
+    for concurrency in args.concurrency:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            start = time.perf_counter()
+            latencies = sorted(executor.map(login, range(args.logins)))
+            elapsed = time.perf_counter() - start
+        print("concurrency=%-4d logins/s=%-8.1f p50=%.3fs p99=%.3fs" % (
+            concurrency, args.logins / elapsed, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+# Load test for every page. Seeds a throwaway database with users, queries
+# and logs, then drives each route through the Flask test client at several
+# levels of concurrency and reports throughput and latency percentiles. Use
+# --output to save the results as JSON so runs can be compared.
+#
+#   python benchmarks/routes.py --users 1000 --queries 100000 --requests 500 --concurrency 1 8 32 --output routes.json
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import create_app
+
+PASSWORD = "password"
+TWOFA = "6316827788"
+TEXTS = ["my dawg is kewl.", "The quick brown fox jumps over the lazy dog.", "Thsi sentense has sevral misteaks in it. " * 20]
+
+
+def percentile(latencies, fraction):
+    return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)]
+
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'throughput': len(latencies) / elapsed,
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+    }
+
+
+def seed(path, users, queries, logs, rounds):
+    # Every user shares one password hash, query n belongs to user n % users
+    connection = sqlite3.connect(path)
+    password = bcrypt.hashpw(PASSWORD.encode('utf8'), bcrypt.gensalt(rounds))
+    twofa = bcrypt.hashpw(TWOFA.encode('utf8'), bcrypt.gensalt(rounds))
+    connection.executemany("INSERT INTO user (username, password, twofa, role) VALUES (?, ?, ?, 'user')",
+                           (("user%d" % number, password, twofa) for number in range(users)))
+    uids = dict(connection.execute("SELECT username, id FROM user"))
+    rng = random.Random(9163)
+    connection.executemany("INSERT INTO query (uid, textout, misspelled) VALUES (?, ?, 'dawg, kewl')",
+                           ((uids["user%d" % (number % users)], rng.choice(TEXTS)) for number in range(queries)))
+    connection.executemany("INSERT INTO log (uid, login, logout) VALUES (?, '2019-11-01 00:00:00', '2019-11-01 00:10:00')",
+                           ((uids["user%d" % rng.randrange(users)],) for _ in range(logs)))
+    owned = {}
+    for qid, uid in connection.execute("SELECT id, uid FROM query"):
+        owned.setdefault(uid, []).append(qid)
+    connection.commit()
+    connection.close()
+    return uids, owned
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Route load test")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=20000)
+    parser.add_argument("--logs", type=int, default=20000)
+    parser.add_argument("--requests", type=int, default=200, help="requests per route and concurrency level")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--routes", nargs="+", default=["login", "spell_check", "history", "query", "login_history"])
+    parser.add_argument("--rounds", type=int, default=4, help="bcrypt work factor of the seeded users")
+    parser.add_argument("--backend", default="python", choices=["python", "binary", "pool"])
+    parser.add_argument("--profile", default=None)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'benchmark.db')
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path,
+        'WTF_CSRF_ENABLED': False,
+        'BCRYPT_LOG_ROUNDS': args.rounds,
+        'BCRYPT_MAX_QUEUE': args.requests * 2,
+        'SPELLCHECK_BACKEND': args.backend,
+        'SPELLCHECK_CACHE_SIZE': 0,
+        # Measure the routes, not the limits
+        'RATE_LIMITS': {},
+        'DB_AUTO_INIT': True,
+    }, profile=args.profile)
+    start = time.perf_counter()
+    uids, owned = seed(path, args.users, args.queries, args.logs, args.rounds)
+    print("seeded %d users, %d queries and %d logs in %.1fs" % (args.users, args.queries, args.logs, time.perf_counter() - start))
+
+    def client_for(name, password=PASSWORD, twofa=TWOFA):
+        client = app.test_client()
+        result = client.post('/login', data={'uname': name, 'pword': password, '2fa': twofa})
+        assert b'Success!' in result.data, result.status
+        return client
+
+    # One logged in client per user keeps session setup out of the measurements
+    clients = {}
+
+    def user_client(number):
+        name = "user%d" % (number % args.users)
+        if name not in clients:
+            clients[name] = client_for(name)
+        return name, clients[name]
+
+    admin = client_for("admin", "Administrator@1", "12345678901")
+    for number in range(min(args.users, args.requests)):
+        user_client(number)
+
+    def login(number):
+        return app.test_client().post('/login', data={'uname': "user%d" % (number % args.users), 'pword': PASSWORD, '2fa': TWOFA})
+
+    def spell_check(number):
+        return user_client(number)[1].post('/spell_check', data={'inputtext': TEXTS[number % len(TEXTS)]})
+
+    def history(number):
+        return user_client(number)[1].get('/history')
+
+    def query(number):
+        name, client = user_client(number)
+        queries = owned.get(uids[name], [0])
+        return client.get('/history/query%d' % queries[number % len(queries)])
+
+    def login_history(number):
+        return admin.post('/login_history', data={'uname': "user%d" % (number % args.users)})
+
+    routes = {'login': login, 'spell_check': spell_check, 'history': history, 'query': query, 'login_history': login_history}
+
+    def timed(route, number):
+        start = time.perf_counter()
+        result = routes[route](number)
+        assert result.status_code == 200, (route, result.status)
+        return time.perf_counter() - start
+
+    results = []
+    for route in args.routes:
+        for concurrency in args.concurrency:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                start = time.perf_counter()
+                latencies = list(executor.map(lambda number: timed(route, number), range(args.requests)))
+                elapsed = time.perf_counter() - start
+            summary = dict(route=route, concurrency=concurrency, **summarize(latencies, elapsed))
+            results.append(summary)
+            print("%-14s concurrency=%-4d requests/s=%-8.1f p50=%.2fms p95=%.2fms p99=%.2fms" % (
+                route, concurrency, summary['throughput'], summary['p50'] * 1000, summary['p95'] * 1000, summary['p99'] * 1000))
+
+    if args.output:
+        with open(args.output, 'w') as fo:
+            json.dump({'benchmark': 'routes', 'time': time.time(), 'python': platform.python_version(),
+                       'arguments': vars(args), 'results': results}, fo, indent=2)
+    write_queue = app.extensions['write_queue']
+    if write_queue is not None:
+        write_queue.close()
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
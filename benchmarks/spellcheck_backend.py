@@ -0,0 +1,110 @@
+# Micro-benchmarks for the spell checker on its own: dictionary load time and
+# memory for each way of loading the word list, and words checked per second
+# by each backend. Use --output to save the results as JSON.
+#
+#   python benchmarks/spellcheck_backend.py --words 200000 --repeat 5 --output backend.json
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import spellcheck
+import suggestions
+
+
+def measure_load(label, load):
+    # Time an untraced load, then load again under tracemalloc for the memory
+    start = time.perf_counter()
+    loaded = load()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    load()
+    memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("load %-24s %8.1fms  peak memory %8.1f MB" % (label, elapsed * 1000, memory / 1024.0 / 1024.0))
+    return loaded, {'name': label, 'seconds': elapsed, 'peak_bytes': memory}
+
+
+def make_text(wordlist, count, seed=9163):
+    rng = random.Random(seed)
+    with open(wordlist) as fo:
+        words = fo.read().split()
+    tokens = []
+    for _ in range(count):
+        word = rng.choice(words)
+        if rng.random() < 0.1:
+            word = word[:-1] + "q"
+        tokens.append(word)
+    return " ".join(tokens)
+
+
+def measure_check(label, check, text, words, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        check(text)
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    print("check %-23s %10.0f words/s  best %8.1fms" % (label, words / best, best * 1000))
+    return {'name': label, 'words_per_second': words / best, 'best_seconds': best, 'seconds': timings}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Spell checker micro-benchmarks")
+    parser.add_argument("--wordlist", default="wordlist.txt")
+    parser.add_argument("--binary", default="./a.out")
+    parser.add_argument("--words", type=int, default=100000, help="words in the checked document")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--backends", nargs="+", default=["python", "mapped", "binary", "pool"])
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    snapshot = os.path.join(directory, 'wordlist.snapshot')
+    loads = []
+    dictionary, result = measure_load("text word list", lambda: spellcheck.Dictionary.load(args.wordlist))
+    loads.append(result)
+    _, result = measure_load("build snapshot", lambda: spellcheck.MappedDictionary.build(args.wordlist, snapshot))
+    loads.append(result)
+    mapped, result = measure_load("mapped snapshot", lambda: spellcheck.load_dictionary(args.wordlist, snapshot))
+    loads.append(result)
+    suggestion_path = os.path.join(directory, 'wordlist.suggest')
+    _, result = measure_load("build suggestion index", lambda: suggestions.SuggestionIndex.build(dictionary, suggestion_path))
+    loads.append(result)
+    _, result = measure_load("mapped suggestion index", lambda: suggestions.SuggestionIndex(suggestion_path))
+    loads.append(result)
+
+    text = make_text(args.wordlist, args.words)
+    checks = []
+    for backend in args.backends:
+        if backend == "python":
+            checks.append(measure_check(backend, lambda text: spellcheck.check_text(text, dictionary), text, args.words, args.repeat))
+        elif backend == "mapped":
+            checks.append(measure_check(backend, lambda text: spellcheck.check_text(text, mapped), text, args.words, args.repeat))
+        elif backend == "binary":
+            if not os.access(args.binary, os.X_OK):
+                print("check %-23s skipped, %s is not available" % (backend, args.binary))
+                continue
+            checks.append(measure_check(backend, lambda text: spellcheck.check_text_binary(text, args.binary, args.wordlist), text, args.words, args.repeat))
+        elif backend == "pool":
+            pool = spellcheck.WorkerPool(spellcheck.worker_command(args.wordlist, snapshot), size=1, timeout=600, health_interval=0)
+            try:
+                checks.append(measure_check(backend, pool.check_text, text, args.words, args.repeat))
+            finally:
+                pool.close()
+
+    if args.output:
+        with open(args.output, 'w') as fo:
+            json.dump({'benchmark': 'spellcheck_backend', 'time': time.time(), 'python': platform.python_version(),
+                       'arguments': vars(args), 'loads': loads, 'checks': checks}, fo, indent=2)
+    os.remove(snapshot)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import csv
+import io
+import json
+
+FORMATS = ('csv', 'jsonl')
+USER_FIELDS = ('username', 'password', 'twofa')
+
+
+def read_users(lines, format):
+    # Yields (username, password, twofa) from CSV with a header row or from
+    # JSON lines, one line at a time so files of any size can be imported.
+    # A line that cannot be read raises ValueError naming it.
+    if format == 'csv':
+        reader = csv.DictReader(lines)
+        try:
+            for record in reader:
+                yield tuple(record.get(field) or '' for field in USER_FIELDS)
+        except csv.Error as e:
+            raise ValueError("line %d: %s" % (reader.line_num, e))
+    else:
+        for number, line in enumerate(lines, 1):
+            if line.strip():
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    raise ValueError("line %d: %s" % (number, e))
+                if not isinstance(record, dict):
+                    raise ValueError("line %d: expected a JSON object" % number)
+                yield tuple(str(record.get(field) or '') for field in USER_FIELDS)
+
+
+def format_rows(columns, rows, format):
+    # Yields an export a row at a time
+    if format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        for row in rows:
+            yield json.dumps(dict(zip(columns, row)), default=str) + '\n'
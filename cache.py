@@ -0,0 +1,115 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def cache_key(text, version, chunk_size=64 * 1024):
+    digest = hashlib.sha256()
+    digest.update((version or '').encode('utf-8'))
+    digest.update(b'\x00')
+    for start in range(0, len(text), chunk_size):
+        digest.update(text[start:start + chunk_size].encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ResultCache(object):
+    # In-process LRU cache of spell check results with a time to live
+    def __init__(self, size=1024, ttl=3600):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (not self.ttl or entry[0] > time.monotonic()):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SqliteResultCache(ResultCache):
+    # Same interface backed by a local sqlite file so every worker process
+    # shares one cache. Values must be JSON serialisable.
+    def __init__(self, path, size=1024, ttl=3600):
+        super(SqliteResultCache, self).__init__(size, ttl)
+        self.path = path
+        self.local = threading.local()
+        connection = self._connection()
+        connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL, used REAL NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+        connection.commit()
+
+    def _connection(self):
+        if not hasattr(self.local, 'connection'):
+            self.local.connection = sqlite3.connect(self.path, timeout=5)
+            self.local.connection.execute("PRAGMA journal_mode=WAL")
+        return self.local.connection
+
+    def get(self, key):
+        connection = self._connection()
+        now = time.time()
+        row = connection.execute("SELECT value, expires FROM results WHERE key = ?", (key,)).fetchone()
+        with self.lock:
+            if row is not None and (not self.ttl or row[1] > now):
+                self.hits += 1
+            else:
+                self.misses += 1
+        if row is None:
+            return None
+        if self.ttl and row[1] <= now:
+            connection.execute("DELETE FROM results WHERE key = ?", (key,))
+            connection.commit()
+            return None
+        connection.execute("UPDATE results SET used = ? WHERE key = ?", (now, key))
+        connection.commit()
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        connection = self._connection()
+        now = time.time()
+        connection.execute("INSERT OR REPLACE INTO results (key, value, expires, used) VALUES (?, ?, ?, ?)",
+                           (key, json.dumps(value), now + self.ttl, now))
+        connection.execute("DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY used DESC LIMIT -1 OFFSET ?)", (self.size,))
+        connection.commit()
+
+    def delete(self, key):
+        connection = self._connection()
+        connection.execute("DELETE FROM results WHERE key = ?", (key,))
+        connection.commit()
+
+    def clear(self):
+        connection = self._connection()
+        connection.execute("DELETE FROM results")
+        connection.commit()
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM results").fetchone()[0]
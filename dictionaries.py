@@ -0,0 +1,50 @@
+import os
+import threading
+from collections import namedtuple
+
+# A loaded word list. Entries are never changed once built: a reload builds a
+# new entry and swaps it in, so checks already holding the old one finish
+# with it and no check ever waits for a reload.
+Entry = namedtuple('Entry', 'name wordlist snapshot dictionary suggestion_index stat')
+
+
+def wordlist_stat(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class DictionaryRegistry(object):
+    # Named dictionaries, e.g. one per language or tenant. load(wordlist,
+    # snapshot, suggestion_path) returns (dictionary, suggestion_index).
+    def __init__(self, load):
+        self.load = load
+        self.entries = {}
+        # Serialises updates, lookups never take it
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        return self.entries.get(name)
+
+    def names(self):
+        return sorted(self.entries)
+
+    def update(self, sources):
+        # sources maps names to (wordlist, snapshot, suggestion_path). Loads new
+        # and changed word lists, drops removed ones and returns the names of
+        # the entries that were replaced or removed.
+        with self.lock:
+            entries = dict(self.entries)
+            changed = []
+            for name, (wordlist, snapshot, suggestion_path) in sources.items():
+                entry = entries.get(name)
+                stat = wordlist_stat(wordlist)
+                if entry is None or (entry.wordlist, entry.snapshot, entry.stat) != (wordlist, snapshot, stat):
+                    dictionary, suggestion_index = self.load(wordlist, snapshot, suggestion_path)
+                    entries[name] = Entry(name, wordlist, snapshot, dictionary, suggestion_index, stat)
+                    if entry is not None:
+                        changed.append(name)
+            for name in set(entries) - set(sources):
+                del entries[name]
+                changed.append(name)
+            self.entries = entries
+            return changed
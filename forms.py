@@ -0,0 +1,95 @@
+import codecs
+import html
+import re
+from urllib.parse import unquote_to_bytes
+
+CHUNK_SIZE = 64 * 1024
+MAX_NAME_LENGTH = 1024
+
+# Control characters bleach.clean turns into "?", NUL is dropped
+CONTROL = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def read_urlencoded(stream, chunk_size=CHUNK_SIZE, max_name_length=MAX_NAME_LENGTH):
+    # Yields (number, name, text) for an application/x-www-form-urlencoded
+    # body as it is read, number counting the fields from 0. A value comes in
+    # as many pieces as the chunks it spans and its first piece may be empty.
+    # Percent escapes and UTF-8 sequences cut by a chunk boundary are carried
+    # over to the next chunk. A field name over max_name_length raises
+    # ValueError.
+    number = -1
+    name = None
+    key = b''
+    decoder = None
+    pending = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if chunk:
+            data = pending + chunk
+            # Keep a "%" or "%X" at the end for the next chunk
+            cut = data.rfind(b'%', max(len(data) - 2, 0))
+            if cut == -1:
+                pending = b''
+            else:
+                data, pending = data[:cut], data[cut:]
+        else:
+            # The end of the body ends the last field like a "&"
+            data = pending + b'&'
+        for index, part in enumerate(data.split(b'&')):
+            if index:
+                if name is not None:
+                    text = decoder.decode(b'', True)
+                    if text:
+                        yield number, name, text
+                elif key:
+                    # A field without "=" has an empty value
+                    number += 1
+                    yield number, unquote(key), ''
+                name = None
+                key = b''
+            if name is None:
+                start, equal, part = part.partition(b'=')
+                key += start
+                if len(key) > max_name_length:
+                    raise ValueError("Form field name longer than %d bytes" % max_name_length)
+                if not equal:
+                    continue
+                number += 1
+                name = unquote(key)
+                decoder = codecs.getincrementaldecoder('utf-8')('replace')
+                yield number, name, ''
+            text = decoder.decode(unquote_to_bytes(part.replace(b'+', b' ')))
+            if text:
+                yield number, name, text
+        if not chunk:
+            return
+
+
+def unquote(value):
+    return unquote_to_bytes(value.replace(b'+', b' ')).decode('utf-8', 'replace')
+
+
+class Escaper:
+    # Escapes text for HTML a piece at a time the way bleach.clean treats
+    # plain text: &, < and > become entities, line breaks become "\n", NUL is
+    # dropped and other control characters become "?". Tags bleach would keep
+    # are escaped as well.
+    def __init__(self):
+        self.carriage = False
+
+    def escape(self, text, final=False):
+        if self.carriage:
+            text = '\r' + text
+        # A "\r" at the end may be the start of a "\r\n"
+        self.carriage = not final and text.endswith('\r')
+        if self.carriage:
+            text = text[:-1]
+        if '\r' in text:
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+        if CONTROL.search(text):
+            text = CONTROL.sub(lambda match: '' if match.group() == '\x00' else '?', text)
+        return html.escape(text, quote=False)
+
+
+def escape(text):
+    return Escaper().escape(text, final=True)
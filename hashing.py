@@ -0,0 +1,82 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import bcrypt
+
+
+class HashingBusy(Exception):
+    pass
+
+
+def hash_rounds(hashed):
+    # bcrypt hashes look like $2b$12$<salt and digest>
+    if isinstance(hashed, str):
+        hashed = hashed.encode('utf8')
+    try:
+        return int(hashed.split(b'$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class HashingPool(object):
+    # Runs bcrypt on a small thread pool so it does not tie up request threads.
+    # bcrypt releases the GIL, so the pool uses every core. At most
+    # workers + max_queue calls may be running or waiting, anything beyond
+    # that fails fast with HashingBusy instead of queueing up.
+    def __init__(self, workers=4, max_queue=64, timeout=30):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(workers + max_queue)
+        self.timeout = timeout
+
+    def submit(self, function, *args):
+        if not self.slots.acquire(blocking=False):
+            raise HashingBusy()
+        return self._start(function, args)
+
+    def _start(self, function, args):
+        # Runs function on the pool, the caller already holds a slot
+        try:
+            future = self.executor.submit(function, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda future: self.slots.release())
+        return future
+
+    def result(self, future):
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            raise HashingBusy()
+
+    def hashpw(self, password, rounds=12):
+        return self.result(self.submit(_hashpw, password, rounds))
+
+    def hashpw_many(self, passwords, rounds=12):
+        futures = [self.submit(_hashpw, password, rounds) for password in passwords]
+        return [self.result(future) for future in futures]
+
+    def hashpw_stream(self, passwords, rounds=12):
+        # For bulk jobs: yields hashes in order, waiting for free slots instead
+        # of failing and keeping no more than one hash per worker in flight so
+        # requests still find room in the queue
+        pending = deque()
+        for password in passwords:
+            if len(pending) >= self.workers:
+                yield self.result(pending.popleft())
+            self.slots.acquire()
+            pending.append(self._start(_hashpw, (password, rounds)))
+        while pending:
+            yield self.result(pending.popleft())
+
+    def checkpw(self, password, hashed):
+        return self.result(self.submit(bcrypt.checkpw, password, hashed))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+def _hashpw(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
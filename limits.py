@@ -0,0 +1,127 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class RateLimited(Exception):
+    # retry_after is the number of seconds until a token is available
+    def __init__(self, retry_after):
+        super(RateLimited, self).__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class ConcurrencyBusy(Exception):
+    pass
+
+
+def refill(tokens, updated, now, capacity, rate):
+    return min(capacity, tokens + max(now - updated, 0) * rate)
+
+
+class RateLimiter(object):
+    # Token buckets held in process. Each key gets capacity tokens that refill
+    # at rate per second; take spends one or raises RateLimited. The least
+    # recently used buckets are dropped beyond size, a dropped bucket starts
+    # full again.
+    def __init__(self, size=100000):
+        self.size = size
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (capacity, now))
+            tokens = refill(tokens, updated, now, capacity, rate)
+            allowed = tokens >= 1
+            self.buckets[key] = (tokens - 1 if allowed else tokens, now)
+            self.buckets.move_to_end(key)
+            while len(self.buckets) > self.size:
+                self.buckets.popitem(last=False)
+        if not allowed:
+            raise RateLimited((1 - tokens) / rate)
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+    def __len__(self):
+        return len(self.buckets)
+
+
+class SqliteRateLimiter(RateLimiter):
+    # Same interface backed by a local sqlite file so every worker process
+    # shares the buckets. Buckets that have refilled are pruned now and then.
+    def __init__(self, path, size=100000, prune_interval=60):
+        super(SqliteRateLimiter, self).__init__(size)
+        self.path = path
+        self.prune_interval = prune_interval
+        self.pruned = time.time()
+        self.local = threading.local()
+        connection = self._connection()
+        connection.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, full REAL NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS buckets_full ON buckets (full)")
+        connection.commit()
+
+    def _connection(self):
+        if not hasattr(self.local, 'connection'):
+            self.local.connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self.local.connection.execute("PRAGMA journal_mode=WAL")
+        return self.local.connection
+
+    def take(self, key, capacity, rate):
+        connection = self._connection()
+        now = time.time()
+        # Take the write lock first so read, refill and write are one step
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens = refill(row[0], row[1], now, capacity, rate) if row else capacity
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            connection.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated, full) VALUES (?, ?, ?, ?)",
+                               (key, tokens, now, now + (capacity - tokens) / rate))
+            if now - self.pruned >= self.prune_interval:
+                self.pruned = now
+                connection.execute("DELETE FROM buckets WHERE full < ?", (now,))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        if not allowed:
+            raise RateLimited((1 - tokens) / rate)
+
+    def clear(self):
+        self._connection().execute("DELETE FROM buckets")
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM buckets").fetchone()[0]
+
+
+class ConcurrencyLimit(object):
+    # Lets limit callers in at once. Up to max_waiting more wait at most
+    # timeout seconds for a slot, anyone beyond that gets ConcurrencyBusy
+    # straight away.
+    def __init__(self, limit, max_waiting=0, timeout=5):
+        self.slots = threading.BoundedSemaphore(limit)
+        self.queue = threading.BoundedSemaphore(limit + max_waiting)
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.active = 0
+
+    def acquire(self):
+        if not self.queue.acquire(blocking=False):
+            raise ConcurrencyBusy()
+        if not self.slots.acquire(timeout=self.timeout):
+            self.queue.release()
+            raise ConcurrencyBusy()
+        with self.lock:
+            self.active += 1
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+        self.slots.release()
+        self.queue.release()
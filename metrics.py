@@ -0,0 +1,135 @@
+import bisect
+import cProfile
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds, from sub-millisecond lookups to slow bcrypt calls
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for name, value in items)
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics(object):
+    # Counters, histograms and gauges kept in process and rendered in the
+    # Prometheus text format. Labels are passed as keyword arguments.
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.help = {}
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def describe(self, name, help):
+        self.help[name] = help
+
+    def increment(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = [[0] * len(self.buckets), 0.0, 0]
+            position = bisect.bisect_left(self.buckets, value)
+            if position < len(self.buckets):
+                histogram[0][position] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def gauge(self, name, function, help=None):
+        # function is called at render time and returns the current value
+        self.gauges[name] = function
+        if help:
+            self.describe(name, help)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            counters = dict((name, dict(series)) for name, series in self.counters.items())
+            histograms = dict((name, dict((key, [list(histogram[0]), histogram[1], histogram[2]]) for key, histogram in series.items()))
+                              for name, series in self.histograms.items())
+        for name in sorted(counters):
+            self._header(lines, name, 'counter')
+            for key, value in sorted(counters[name].items()):
+                lines.append('%s%s %s' % (name, format_labels(key), format_value(value)))
+        for name in sorted(histograms):
+            self._header(lines, name, 'histogram')
+            for key, (counts, total, count) in sorted(histograms[name].items()):
+                cumulative = 0
+                for bound, bucket in zip(self.buckets, counts):
+                    cumulative += bucket
+                    lines.append('%s_bucket%s %d' % (name, format_labels(key, ('le', format_value(float(bound)))), cumulative))
+                lines.append('%s_bucket%s %d' % (name, format_labels(key, ('le', '+Inf')), count))
+                lines.append('%s_sum%s %s' % (name, format_labels(key), format_value(total)))
+                lines.append('%s_count%s %d' % (name, format_labels(key), count))
+        for name in sorted(self.gauges):
+            self._header(lines, name, 'gauge')
+            lines.append('%s %s' % (name, format_value(self.gauges[name]())))
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, lines, name, kind):
+        if name in self.help:
+            lines.append('# HELP %s %s' % (name, self.help[name]))
+        lines.append('# TYPE %s %s' % (name, kind))
+
+
+class Profiler(object):
+    # Profiles a random sample of requests while enabled and keeps the
+    # profiles of those slower than threshold seconds as .prof files that
+    # pstats or snakeviz can read. It can be switched on and off at runtime.
+    def __init__(self, directory, threshold=1.0, sample_rate=1.0, enabled=False):
+        self.directory = directory
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.saved = 0
+
+    def start(self):
+        if not self.enabled or random.random() >= self.sample_rate:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already running on this thread
+            return None
+        return profile
+
+    def stop(self, profile, elapsed, name):
+        profile.disable()
+        if elapsed < self.threshold:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        with self.lock:
+            self.saved += 1
+            path = os.path.join(self.directory, '%s-%d-%d-%d.prof' % (name, int(time.time()), os.getpid(), self.saved))
+        profile.dump_stats(path)
+        return path
@@ -0,0 +1,62 @@
+import difflib
+import re
+
+import spellcheck
+
+# Texts are compared line by line, the unit the checkers work in. Lines keep
+# their newline so the pieces of a text always join back into it.
+LINE = re.compile(r'[^\n]*\n|[^\n]+')
+
+
+def split_lines(text):
+    return LINE.findall(text)
+
+
+def changes(old, new):
+    # Yields (start, end, lines) for every run of lines in new that replaces
+    # the characters start:end of old
+    old_lines, new_lines = split_lines(old), split_lines(new)
+    offsets = [0]
+    for line in old_lines:
+        offsets.append(offsets[-1] + len(line))
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != 'equal':
+            yield offsets[i1], offsets[i2], new_lines[j1:j2]
+
+
+def text_delta(old, new):
+    # A compact edit script turning old into new: [[start, end, text], ...]
+    return [[start, end, ''.join(lines)] for start, end, lines in changes(old, new)]
+
+
+def apply_delta(old, delta):
+    pieces = []
+    position = 0
+    for start, end, text in delta:
+        pieces.append(old[position:start])
+        pieces.append(text)
+        position = end
+    pieces.append(old[position:])
+    return ''.join(pieces)
+
+
+def recheck(old, new, old_misspelled, check, limit=spellcheck.MAX_MISSPELLED):
+    # Spell checks new given the complete result of checking old. A token is
+    # misspelled or not wherever it appears, so only the lines that changed
+    # are passed to check and every other token is looked up in the results
+    # already known. Returns the misspelled words of new and the number of
+    # lines checked.
+    changed = [''.join(lines) for start, end, lines in changes(old, new)]
+    misspelled = set(old_misspelled)
+    if changed:
+        # Keep the runs apart so the last line of one does not run into the next
+        misspelled.update(check('\n'.join(changed)))
+    words = []
+    for word in spellcheck.tokenize(spellcheck.encode_chunks(new)):
+        word = word.decode('utf-8', 'replace')
+        if word in misspelled:
+            words.append(word)
+            if len(words) >= limit:
+                break
+    return words, sum(len(split_lines(text)) for text in changed)
@@ -0,0 +1,422 @@
+import array
+import hashlib
+import itertools
+import mmap
+import os
+import queue
+import re
+import select
+import string
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+# Mirrors the behaviour of the a.out checker so both backends agree:
+# dictionary lines are read in fgets() sized chunks and cut at the first
+# whitespace or curly quote byte, input is split into lines and then on
+# spaces, surrounding punctuation is stripped and numbers are always correct.
+LINE_LENGTH = 44
+MAX_MISSPELLED = 1000
+CHUNK_SIZE = 64 * 1024
+MEMO_SIZE = 65536
+PUNCTUATION = string.punctuation.encode('ascii')
+WORD_END = re.compile(rb'[\x00 \t\n\v\f\r\x80\x9c\x9d\xe2]')
+TOKEN = re.compile(rb'[^ ]+')
+
+# Worker protocol: every request and response is a 4 byte big-endian length
+# followed by the payload. A request is a document, a response is the
+# misspelled words separated by newlines. An empty request is a ping.
+FRAME = struct.Struct('>I')
+
+# Dictionary snapshot header: magic, sha1 of the wordlist it was built from,
+# the wordlist size and mtime when it was built, the number of words and the
+# number of hash table slots.
+# Offsets are stored in native byte order as the file is a local cache.
+SNAPSHOT_MAGIC = b'SPDICT1\x00'
+SNAPSHOT_HEADER = struct.Struct('<8s20sQQII')
+
+
+class CheckerError(Exception):
+    pass
+
+
+class Dictionary(object):
+    def __init__(self, words, version=None):
+        self.words = frozenset(words)
+        self.version = version
+
+    @classmethod
+    def load(cls, path):
+        words = set()
+        digest = hashlib.sha1()
+        with open(path, 'rb') as fo:
+            for line in fo:
+                digest.update(line)
+                for start in range(0, len(line), LINE_LENGTH):
+                    words.add(WORD_END.split(line[start:start + LINE_LENGTH], 1)[0])
+        return cls(words, digest.hexdigest())
+
+    def __len__(self):
+        return len(self.words)
+
+    def __iter__(self):
+        return iter(self.words)
+
+    def __contains__(self, word):
+        return word in self.words
+
+    def check(self, word):
+        if not word or word.isdigit():
+            return True
+        return word in self or word.lower() in self
+
+
+class MappedDictionary(Dictionary):
+    # Read only view of a snapshot file: a header, the offsets of the sorted
+    # words, an open addressing hash table of word numbers and then the words
+    # back to back. The file is memory mapped so every process checking
+    # against it shares the same pages.
+    def __init__(self, path):
+        with open(path, 'rb') as fo:
+            self.map = mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, digest, self.source_size, self.source_mtime, self.count, slots = SNAPSHOT_HEADER.unpack_from(self.map)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("%s is not a dictionary snapshot" % path)
+        self.version = digest.hex()
+        view = memoryview(self.map)
+        start = SNAPSHOT_HEADER.size
+        self.offsets = view[start:start + 4 * (self.count + 1)].cast('I')
+        start += 4 * (self.count + 1)
+        self.slots = view[start:start + 4 * slots].cast('I')
+        self.mask = slots - 1
+        self.base = start + 4 * slots
+
+    @staticmethod
+    def build(wordlist, path):
+        stat = os.stat(wordlist)
+        dictionary = Dictionary.load(wordlist)
+        words = sorted(dictionary.words)
+        offsets = array.array('I', [0])
+        for word in words:
+            offsets.append(offsets[-1] + len(word))
+        # Keep the table at most half full so probes stay short
+        size = 1
+        while size < 2 * len(words):
+            size *= 2
+        slots = array.array('I', bytes(4 * size))
+        for position, word in enumerate(words):
+            slot = zlib.crc32(word) & (size - 1)
+            while slots[slot]:
+                slot = (slot + 1) & (size - 1)
+            slots[slot] = position + 1
+        temporary = "%s.%d.tmp" % (path, os.getpid())
+        with open(temporary, 'wb') as fo:
+            fo.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, bytes.fromhex(dictionary.version), stat.st_size, stat.st_mtime_ns, len(words), size))
+            fo.write(offsets.tobytes())
+            fo.write(slots.tobytes())
+            fo.write(b''.join(words))
+        os.replace(temporary, path)
+
+    def fresh(self, wordlist):
+        # Trust size and mtime, fall back to the content hash when only the mtime moved
+        stat = os.stat(wordlist)
+        if stat.st_size != self.source_size:
+            return False
+        if stat.st_mtime_ns == self.source_mtime:
+            return True
+        with open(wordlist, 'rb') as fo:
+            return hashlib.sha1(fo.read()).hexdigest() == self.version
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, position):
+        if not 0 <= position < self.count:
+            raise IndexError(position)
+        return self.map[self.base + self.offsets[position]:self.base + self.offsets[position + 1]]
+
+    def __iter__(self):
+        for position in range(self.count):
+            yield self[position]
+
+    def __contains__(self, word):
+        slot = zlib.crc32(word) & self.mask
+        while True:
+            position = self.slots[slot]
+            if not position:
+                return False
+            if self[position - 1] == word:
+                return True
+            slot = (slot + 1) & self.mask
+
+
+def load_dictionary(wordlist, snapshot=None):
+    # Use the compiled snapshot when given, rebuilding it if wordlist changed
+    if not snapshot:
+        return Dictionary.load(wordlist)
+    try:
+        dictionary = MappedDictionary(snapshot)
+        if dictionary.fresh(wordlist):
+            return dictionary
+    except (OSError, ValueError, struct.error):
+        pass
+    MappedDictionary.build(wordlist, snapshot)
+    return MappedDictionary(snapshot)
+
+
+def encode_chunks(text, size=CHUNK_SIZE):
+    for start in range(0, len(text), size):
+        yield text[start:start + size].encode('utf-8')
+
+
+def tokenize(chunks):
+    # Takes bytes or an iterable of byte chunks. Chunks are only cut after the
+    # last space or newline they contain, so memory stays bounded by the chunk
+    # size and the longest token rather than the size of the document.
+    if isinstance(chunks, bytes):
+        chunks = (chunks,)
+    buffer = bytearray()
+    # a.out stops reading a line at a NUL byte, and the line may continue into the next chunk
+    skip = False
+    for chunk in itertools.chain(chunks, (None,)):
+        if chunk is None:
+            region = bytes(buffer)
+        else:
+            end = max(chunk.rfind(b' '), chunk.rfind(b'\n')) + 1
+            if not end:
+                buffer += chunk
+                continue
+            buffer += chunk[:end]
+            region = bytes(buffer)
+            buffer[:] = chunk[end:]
+        for number, line in enumerate(region.split(b'\n')):
+            if number:
+                skip = False
+            if skip:
+                continue
+            if b'\x00' in line:
+                line = line.split(b'\x00', 1)[0]
+                skip = True
+            for match in TOKEN.finditer(line):
+                yield WORD_END.split(match.group(), 1)[0].strip(PUNCTUATION)
+
+
+def check_data(data, dictionary, limit=MAX_MISSPELLED):
+    misspelled = []
+    # Each distinct token is only looked up once per document
+    known = {}
+    for word in tokenize(data):
+        result = known.get(word)
+        if result is None:
+            result = dictionary.check(word)
+            if len(known) < MEMO_SIZE:
+                known[word] = result
+        if not result:
+            misspelled.append(word)
+            if len(misspelled) >= limit:
+                break
+    return misspelled
+
+
+def check_text(text, dictionary, limit=MAX_MISSPELLED):
+    return [word.decode('utf-8', 'replace') for word in check_data(encode_chunks(text), dictionary, limit)]
+
+
+def check_text_binary(text, binary, wordlist, timings=None):
+    # a.out seeks to size its input so it cannot read from a pipe; hand it an
+    # anonymous in-memory file instead, or a private temporary file where
+    # memfd_create() is not available. Seconds spent writing the input and
+    # running a.out are added to timings when it is given.
+    start = time.perf_counter()
+    if hasattr(os, 'memfd_create'):
+        fd = os.memfd_create('spellcheck')
+        try:
+            for chunk in encode_chunks(text):
+                os.write(fd, chunk)
+            written = time.perf_counter()
+            output = subprocess.check_output([binary, '/dev/fd/%d' % fd, wordlist], pass_fds=(fd,))
+        finally:
+            os.close(fd)
+    else:
+        with tempfile.NamedTemporaryFile(suffix='.txt') as fo:
+            for chunk in encode_chunks(text):
+                fo.write(chunk)
+            fo.flush()
+            written = time.perf_counter()
+            output = subprocess.check_output([binary, fo.name, wordlist])
+    if timings is not None:
+        timings['input'] = timings.get('input', 0.0) + written - start
+        timings['binary'] = timings.get('binary', 0.0) + time.perf_counter() - written
+    output = output.decode('utf-8').strip()
+    return output.split('\n') if output else []
+
+
+def _write_all(fd, data, deadline):
+    view = memoryview(data)
+    while view:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not select.select([], [fd], [], remaining)[1]:
+            raise CheckerError("Timed out writing to checker worker")
+        try:
+            view = view[os.write(fd, view):]
+        except BlockingIOError:
+            pass
+
+
+def _read_exact(fd, size, deadline):
+    chunks = []
+    while size:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+            raise CheckerError("Timed out waiting for checker worker")
+        chunk = os.read(fd, min(size, 65536))
+        if not chunk:
+            raise CheckerError("Checker worker exited")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+class Worker(object):
+    def __init__(self, command):
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.stdin = self.process.stdin.fileno()
+        self.stdout = self.process.stdout.fileno()
+        os.set_blocking(self.stdin, False)
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def request(self, data, timeout):
+        deadline = time.monotonic() + timeout
+        try:
+            _write_all(self.stdin, FRAME.pack(len(data)) + data, deadline)
+            size = FRAME.unpack(_read_exact(self.stdout, FRAME.size, deadline))[0]
+            return _read_exact(self.stdout, size, deadline)
+        except OSError as e:
+            raise CheckerError("Checker worker failed: %s" % e)
+
+    def ping(self, timeout):
+        try:
+            return self.alive() and self.request(b'', timeout) == b''
+        except CheckerError:
+            return False
+
+    def close(self):
+        if self.alive():
+            self.process.kill()
+        self.process.wait()
+        self.process.stdin.close()
+        self.process.stdout.close()
+
+
+class WorkerPool(object):
+    def __init__(self, command, size=4, timeout=10.0, health_interval=30.0):
+        self.command = command
+        self.timeout = timeout
+        self.workers = queue.LifoQueue()
+        for _ in range(size):
+            self.workers.put(Worker(command))
+        self.closed = threading.Event()
+        if health_interval:
+            thread = threading.Thread(target=self._monitor, args=(health_interval,), daemon=True)
+            thread.start()
+
+    def _acquire(self, timeout):
+        try:
+            worker = self.workers.get(timeout=timeout)
+        except queue.Empty:
+            raise CheckerError("No checker worker available")
+        if not worker.alive():
+            worker.close()
+            worker = Worker(self.command)
+        return worker
+
+    def request(self, data):
+        worker = self._acquire(self.timeout)
+        try:
+            return worker.request(data, self.timeout)
+        except CheckerError:
+            # The worker may be hung or half way through a frame, replace it
+            worker.close()
+            worker = Worker(self.command)
+            raise
+        finally:
+            if self.closed.is_set():
+                worker.close()
+            else:
+                self.workers.put(worker)
+
+    def check_text(self, text):
+        output = self.request(text.encode('utf-8')).decode('utf-8', 'replace')
+        return output.split('\n') if output else []
+
+    def _take_unchecked(self, checked):
+        # The least recently used idle worker not in checked. Requests take
+        # from the other end of the stack, so they keep getting warm workers.
+        with self.workers.mutex:
+            for index, worker in enumerate(self.workers.queue):
+                if worker not in checked:
+                    del self.workers.queue[index]
+                    return worker
+        return None
+
+    def health_check(self):
+        # Ping every idle worker once and replace the ones that do not answer.
+        # Only one worker is out of the pool at a time, so a hung worker
+        # holds up one slot rather than every request.
+        checked = set()
+        while not self.closed.is_set():
+            worker = self._take_unchecked(checked)
+            if worker is None:
+                break
+            if not worker.ping(self.timeout):
+                worker.close()
+                worker = Worker(self.command)
+            checked.add(worker)
+            if self.closed.is_set():
+                worker.close()
+            else:
+                self.workers.put(worker)
+
+    def _monitor(self, interval):
+        while not self.closed.wait(interval):
+            self.health_check()
+
+    def close(self):
+        self.closed.set()
+        while True:
+            try:
+                self.workers.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def worker_command(wordlist, snapshot=None):
+    return [sys.executable, os.path.abspath(__file__), 'serve', wordlist] + ([snapshot] if snapshot else [])
+
+
+def serve(dictionary, stdin, stdout):
+    while True:
+        header = stdin.read(FRAME.size)
+        if len(header) < FRAME.size:
+            return
+        data = stdin.read(FRAME.unpack(header)[0])
+        output = b'\n'.join(check_data(data, dictionary))
+        stdout.write(FRAME.pack(len(output)) + output)
+        stdout.flush()
+
+
+if __name__ == "__main__":
+    # spellcheck.py serve wordlist.txt [wordlist.snapshot]  runs a pool worker
+    # spellcheck.py build wordlist.txt wordlist.snapshot    compiles a snapshot
+    if len(sys.argv) < 3 or sys.argv[1] not in ('serve', 'build') or (sys.argv[1] == 'build' and len(sys.argv) != 4):
+        sys.exit("Usage: spellcheck.py serve wordlist.txt [snapshot] | build wordlist.txt snapshot")
+    if sys.argv[1] == 'build':
+        MappedDictionary.build(sys.argv[2], sys.argv[3])
+    else:
+        serve(load_dictionary(*sys.argv[2:4]), sys.stdin.buffer, sys.stdout.buffer)
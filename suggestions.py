@@ -0,0 +1,191 @@
+import array
+import itertools
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+# Symmetric delete index: every dictionary word is stored under each string
+# that can be produced by deleting up to max_distance characters from its
+# prefix. Deleting the same number of characters from a misspelling then
+# finds every candidate within max_distance without scanning the dictionary.
+#
+# Index file header: magic, max_distance, prefix_length, the number of words,
+# of delete strings and of hash table slots, and the length of the dictionary
+# version that follows it, padded to 4 bytes. Then come the word offsets, the
+# delete string offsets, the offsets of each delete string's word numbers, the
+# hash table of delete string numbers, the word numbers, and last the words
+# and delete strings back to back in UTF-8. Like dictionary snapshots it is a
+# local cache in native byte order.
+INDEX_MAGIC = b'SPSUGG1\x00'
+INDEX_HEADER = struct.Struct('<8sIIIIII')
+
+
+def deletes(word, max_distance):
+    results = {word}
+    frontier = {word}
+    for _ in range(max_distance):
+        frontier = {candidate[:i] + candidate[i + 1:] for candidate in frontier for i in range(len(candidate))}
+        results |= frontier
+    return results
+
+
+def offsets(items):
+    # Where each item starts when they are stored back to back, and the total
+    return array.array('I', itertools.chain([0], itertools.accumulate(map(len, items))))
+
+
+def edit_distance(source, target, max_distance):
+    # Optimal string alignment distance, gives up once max_distance is exceeded
+    if abs(len(source) - len(target)) > max_distance:
+        return max_distance + 1
+    previous2 = None
+    previous = list(range(len(target) + 1))
+    for i in range(1, len(source) + 1):
+        current = [i] + [0] * len(target)
+        for j in range(1, len(target) + 1):
+            cost = 0 if source[i - 1] == target[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and source[i - 1] == target[j - 2] and source[i - 2] == target[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+class SuggestionIndex(object):
+    # Read only view of an index file. It is memory mapped, so every process
+    # suggesting from the same word list shares the same pages.
+    def __init__(self, path):
+        with open(path, 'rb') as fo:
+            self.map = mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.max_distance, self.prefix_length, self.count, keys, slots, length = INDEX_HEADER.unpack_from(self.map)
+        if magic != INDEX_MAGIC:
+            raise ValueError("%s is not a suggestion index" % path)
+        start = INDEX_HEADER.size
+        self.version = self.map[start:start + length].decode('utf-8')
+        start += (length + 3) // 4 * 4
+        view = memoryview(self.map)
+        self.word_offsets = view[start:start + 4 * (self.count + 1)].cast('I')
+        start += 4 * (self.count + 1)
+        self.key_offsets = view[start:start + 4 * (keys + 1)].cast('I')
+        start += 4 * (keys + 1)
+        self.posting_offsets = view[start:start + 4 * (keys + 1)].cast('I')
+        start += 4 * (keys + 1)
+        self.slots = view[start:start + 4 * slots].cast('I')
+        self.mask = slots - 1
+        start += 4 * slots
+        self.postings = view[start:start + 4 * self.posting_offsets[keys]].cast('I')
+        self.word_base = start + 4 * self.posting_offsets[keys]
+        self.key_base = self.word_base + self.word_offsets[self.count]
+
+    @staticmethod
+    def build(dictionary, path, max_distance=2, prefix_length=7):
+        # Index lower case forms, remembering the dictionary spelling of each
+        canonical = {}
+        for word in sorted(word.decode('utf-8', 'replace') for word in dictionary if word):
+            lower = word.lower()
+            if lower not in canonical or word == lower:
+                canonical[lower] = word
+        words = sorted(canonical)
+        index = {}
+        for position, word in enumerate(words):
+            for delete in deletes(word[:prefix_length], max_distance):
+                index.setdefault(delete, []).append(position)
+        words = [canonical[word].encode('utf-8') for word in words]
+        keys = [key.encode('utf-8') for key in index]
+        word_offsets = offsets(words)
+        key_offsets = offsets(keys)
+        posting_offsets = offsets(index.values())
+        postings = array.array('I', itertools.chain.from_iterable(index.values()))
+        # Keep the table at most half full so probes stay short
+        size = 1
+        while size < 2 * len(keys):
+            size *= 2
+        slots = array.array('I', bytes(4 * size))
+        for number, key in enumerate(keys):
+            slot = zlib.crc32(key) & (size - 1)
+            while slots[slot]:
+                slot = (slot + 1) & (size - 1)
+            slots[slot] = number + 1
+        version = (dictionary.version or '').encode('utf-8')
+        temporary = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+        with open(temporary, 'wb') as fo:
+            fo.write(INDEX_HEADER.pack(INDEX_MAGIC, max_distance, prefix_length, len(words), len(keys), size, len(version)))
+            fo.write(version + bytes(-len(version) % 4))
+            for table in (word_offsets, key_offsets, posting_offsets, slots, postings):
+                fo.write(table.tobytes())
+            fo.write(b''.join(words))
+            fo.write(b''.join(keys))
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path, dictionary, max_distance=2, prefix_length=7):
+        # Reuse the index file when it was built from the same dictionary with
+        # the same settings, otherwise build it again
+        try:
+            index = cls(path)
+            if (index.version, index.max_distance, index.prefix_length) == (dictionary.version or '', max_distance, prefix_length):
+                return index
+        except (OSError, ValueError, struct.error):
+            pass
+        cls.build(dictionary, path, max_distance, prefix_length)
+        return cls(path)
+
+    def word(self, position):
+        return self.map[self.word_base + self.word_offsets[position]:self.word_base + self.word_offsets[position + 1]].decode('utf-8')
+
+    def candidates(self, delete):
+        # Numbers of the words stored under delete
+        key = delete.encode('utf-8')
+        slot = zlib.crc32(key) & self.mask
+        while True:
+            number = self.slots[slot]
+            if not number:
+                return ()
+            number -= 1
+            if self.map[self.key_base + self.key_offsets[number]:self.key_base + self.key_offsets[number + 1]] == key:
+                return self.postings[self.posting_offsets[number]:self.posting_offsets[number + 1]]
+            slot = (slot + 1) & self.mask
+
+    def suggest(self, word, count=5):
+        lower = word.lower()
+        if not lower:
+            return []
+        candidates = set()
+        for delete in deletes(lower[:self.prefix_length], self.max_distance):
+            candidates.update(self.candidates(delete))
+        ranked = []
+        for position in candidates:
+            candidate = self.word(position)
+            distance = edit_distance(lower, candidate.lower(), self.max_distance)
+            if distance <= self.max_distance:
+                # Without word frequencies prefer common lower case words, then
+                # swapped letters, then words keeping the first letter and length
+                ranked.append((distance, not candidate.islower(), sorted(candidate.lower()) != sorted(lower),
+                               candidate[0].lower() != lower[0], abs(len(candidate) - len(lower)), candidate))
+        ranked.sort()
+        return [rank[-1] for rank in ranked[:count]]
+
+
+class LazySuggestionIndex(object):
+    # Stands in for the index of a dictionary until the first suggestion, so
+    # processes that never suggest anything never build or map the file
+    def __init__(self, path, dictionary, max_distance=2, prefix_length=7):
+        self.path = path
+        self.dictionary = dictionary
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        self.index = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.index is None:
+                self.index = SuggestionIndex.load(self.path, self.dictionary, self.max_distance, self.prefix_length)
+            return self.index
+
+    def suggest(self, word, count=5):
+        return (self.index or self.load()).suggest(word, count)
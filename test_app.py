@@ -1,17 +1,43 @@
 import pytest
 from app import create_app
+import hashing
 import os
+import sqlite3
+import json
+import time
+import tracemalloc
+import io
+import forms
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+# Settings shared by every test app: a cheap bcrypt cost, and
+# queries and logs written straight away so tests can read them back directly
+TEST_CONFIG = {'BCRYPT_LOG_ROUNDS': 4, 'DB_WRITE_BEHIND': False}
+
+def database(path):
+    return {'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(path)}
+
+def connect(app):
+    # A DB-API connection to the app's database, in memory or not
+    return app.extensions['sqlalchemy'].db.engine.raw_connection()
 
 @pytest.fixture
 def app():
-    if os.path.exists("spellchecker.db"):
-        os.remove("spellchecker.db")
-    app = create_app()
+    # Every test gets a fresh in-memory database so tests can run in parallel (pytest -n auto)
+    app = create_app(dict(TEST_CONFIG, SQLALCHEMY_DATABASE_URI = 'sqlite://'))
     # Turn off CSRF to prevent token issues (security tests not needed according to assignment)
     app.config['WTF_CSRF_ENABLED'] = False
     client = app.test_client()
     return client
 
+@pytest.fixture
+def file_app(tmpdir):
+    # Threads each need a connection of their own, which an in-memory database cannot give them
+    app = create_app(dict(TEST_CONFIG, **database(tmpdir.join("spellchecker.db"))))
+    app.config['WTF_CSRF_ENABLED'] = False
+    return app.test_client()
+
 # Check if home page is loading properly
 def test_home(app):
     # Before login
@@ -360,3 +386,598 @@ def test_logout(app):
 
     
     
+
+# Check that concurrent spell checks never see each other's input
+@pytest.mark.parametrize("backend", ["python", "binary", "pool"])
+def test_spellcheck_concurrent(file_app, backend):
+    app = file_app
+    flask_app = app.application
+    flask_app.config['SPELLCHECK_BACKEND'] = backend
+    app.post('/register', data = {'uname':"jonathan", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+
+    def check(i):
+        client = flask_app.test_client()
+        with client.session_transaction() as sess:
+            sess['username'] = "jonathan"
+        result = client.post('/spell_check', data = {'inputtext':"my dawg number%d is kewl" % i}, follow_redirects=True)
+        return result.status_code, result.data
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        results = list(executor.map(check, range(200)))
+    for i, (status, data) in enumerate(results):
+        assert status == 200
+        assert ('<div id="misspelled" style = "color: black">dawg, number%d, kewl</div>' % i).encode() in data
+    assert not os.path.exists("test.txt")
+    # Check that every query was recorded
+    with app.session_transaction() as sess:
+        sess['username'] = "jonathan"
+    result = app.get('/history', follow_redirects=True)
+    assert b'<div id="numqueries">Total number of queries: 200</div>' in result.data
+
+# Check that the batch spell check API is working properly
+def test_spellcheck_batch(app):
+    # Check that the API requires a login
+    result = app.post('/api/spell_check/batch', json = ["my dawg is kewl."])
+    assert result.status_code == 401
+
+    # Register and login
+    app.post('/register', data = {'uname':"jonathan", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    app.post('/login', data = {'uname':"jonathan", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+
+    # Check that every document gets its own results in order
+    result = app.post('/api/spell_check/batch', json = ["my dawg is kewl.", "second query", "test quiery"])
+    assert result.status_code == 200
+    assert result.get_json() == {'results': [["dawg", "kewl"], [], ["quiery"]]}
+    # Check that all documents were saved
+    result = app.get('/history', follow_redirects=True)
+    assert b'<div id="numqueries">Total number of queries: 3</div>' in result.data
+    result = app.get('/history/query3', follow_redirects=True)
+    assert b'<div id="querytext">Text Submitted: test quiery</div>' in result.data
+    assert b'<div id="queryresults">Misspelled Words: quiery</div>' in result.data
+    # Check that suggestions are only worked out once a page shows them
+    results = app.application.extensions['spellcheck_cache']
+    assert all(value[1] is None for expires, value in results.entries.values())
+    result = app.post('/spell_check', data = {'inputtext':"test quiery"}, follow_redirects=True)
+    assert b'<div id="suggestion1" style = "color: black">quiery: query' in result.data
+
+    # Check that malformed and oversized requests are rejected
+    assert app.post('/api/spell_check/batch', json = {'text': "my dawg"}).status_code == 400
+    assert app.post('/api/spell_check/batch', json = ["ok", 1]).status_code == 400
+    app.application.config['SPELLCHECK_BATCH_MAX_DOCUMENTS'] = 2
+    assert app.post('/api/spell_check/batch', json = ["a", "b", "c"]).status_code == 413
+    app.application.config['SPELLCHECK_BATCH_MAX_BYTES'] = 10
+    assert app.post('/api/spell_check/batch', json = ["a long enough document"]).status_code == 413
+
+# Check that correction suggestions are shown and saved
+def test_spellcheck_suggestions(app):
+    app.post('/register', data = {'uname':"jonathan", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    app.post('/login', data = {'uname':"jonathan", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    result = app.post('/spell_check', data = {'inputtext':"teh quiery"}, follow_redirects=True)
+    assert result.status_code == 200
+    assert b'<div style = "color: black">Suggestions:</div>' in result.data
+    assert b'<div id="suggestion1" style = "color: black">teh: the, ' in result.data
+    assert b'<div id="suggestion2" style = "color: black">quiery: query, ' in result.data
+    result = app.get('/history/query1', follow_redirects=True)
+    assert b'<div id="querysuggestion1">teh: the, ' in result.data
+    assert b'<div id="querysuggestion2">quiery: query, ' in result.data
+    # Check that correct text has no suggestions
+    result = app.post('/spell_check', data = {'inputtext':"second query"}, follow_redirects=True)
+    assert b'Suggestions:' not in result.data
+
+# Check that a database created before newer columns were added is upgraded
+def test_upgrade_schema(tmpdir):
+    path = tmpdir.join("spellchecker.db")
+    connection = sqlite3.connect(str(path))
+    connection.executescript("""
+        CREATE TABLE user (id INTEGER PRIMARY KEY, username VARCHAR(100) NOT NULL, password VARCHAR(100) NOT NULL, twofa VARCHAR(100));
+        CREATE TABLE query (id INTEGER PRIMARY KEY, uid INTEGER REFERENCES user(id), textout TEXT NOT NULL, misspelled TEXT);
+        CREATE TABLE log (id INTEGER PRIMARY KEY, uid INTEGER REFERENCES user(id), login DATETIME NOT NULL, logout DATETIME);
+    """)
+    connection.close()
+    app = create_app(dict(TEST_CONFIG, **database(path)))
+    app.config['WTF_CSRF_ENABLED'] = False
+    client = app.test_client()
+    client.post('/login', data = {'uname':"admin", 'pword':"Administrator@1", '2fa':"12345678901"}, follow_redirects=True)
+    result = client.post('/spell_check', data = {'inputtext':"teh"}, follow_redirects=True)
+    assert b'<div id="suggestion1" style = "color: black">teh: the, ' in result.data
+    connection = sqlite3.connect(str(path))
+    indexes = set(name for name, in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'"))
+    assert indexes >= {'ix_user_username', 'ix_query_uid', 'ix_log_uid_id'}
+
+    # A database with duplicate usernames still starts, without the unique index
+    connection.executescript("""
+        DROP INDEX ix_user_username;
+        INSERT INTO user (username, password) VALUES ('brian', 'x'), ('brian', 'y');
+    """)
+    connection.close()
+    create_app(dict(TEST_CONFIG, **database(path)))
+    connection = sqlite3.connect(str(path))
+    indexes = set(name for name, in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'"))
+    connection.close()
+    assert 'ix_user_username' not in indexes
+
+# Check that repeated checks are cached and the cache is dropped when the word list changes
+def test_spellcheck_cache(app, tmpdir):
+    flask_app = app.application
+    results = flask_app.extensions['spellcheck_cache']
+    app.post('/register', data = {'uname':"jonathan", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    app.post('/login', data = {'uname':"jonathan", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    app.post('/spell_check', data = {'inputtext':"my dawg is kewl."}, follow_redirects=True)
+    result = app.post('/spell_check', data = {'inputtext':"my dawg is kewl."}, follow_redirects=True)
+    assert b'<div id="misspelled" style = "color: black">dawg, kewl</div>' in result.data
+    assert (results.hits, results.misses) == (1, 1)
+
+    # Point the app at an edited copy of the word list
+    wordlist = tmpdir.join("wordlist.txt")
+    wordlist.write_binary(open("wordlist.txt", "rb").read() + b"dawg\n")
+    flask_app.config.update(SPELLCHECK_WORDLIST = str(wordlist), SPELLCHECK_DICTIONARY_SNAPSHOT = str(tmpdir.join("wordlist.snapshot")),
+                            SPELLCHECK_SUGGESTIONS = 0, SPELLCHECK_RELOAD_INTERVAL = 0.001)
+    time.sleep(0.01)
+    # The reload runs in the background, the request starting it does not wait
+    app.get('/')
+    reload_state = flask_app.extensions['dictionary_reload']
+    reload_state['thread'].join(30)
+    flask_app.config['SPELLCHECK_RELOAD_INTERVAL'] = 0
+    result = app.post('/spell_check', data = {'inputtext':"my dawg is kewl."}, follow_redirects=True)
+    assert b'<div id="misspelled" style = "color: black">kewl</div>' in result.data
+    assert len(results) == 1
+    assert (results.hits, results.misses) == (1, 2)
+
+# Check that documents up to the limit are checked in bounded memory and bigger ones are refused unread
+def test_spellcheck_large(app):
+    app.post('/register', data = {'uname':"jonathan", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    app.post('/login', data = {'uname':"jonathan", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    flask_app = app.application
+    assert flask_app.config['SPELLCHECK_MAX_INPUT_BYTES'] == 50 * 1024 * 1024
+    for document in ["my dawg is kewl. " * 250000, "a <b>dawg</b> & kewl\r\n" * 100000]:
+        body = urlencode({'inputtext':document, 'dictionary':"default"}).encode()
+        tracemalloc.start()
+        result = app.post('/spell_check', input_stream = io.BytesIO(body), content_type = "application/x-www-form-urlencoded",
+                          content_length = len(body))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        assert result.status_code == 200
+        assert b'<div id="misspelled" style = "color: black">' in result.data
+        # The body is read in chunks, the escaped text is held once for the
+        # stored query and the page, and once more while its pieces are joined
+        assert peak < 5 * len(body)
+    connection = connect(flask_app)
+    textout, = connection.execute("SELECT textout FROM query ORDER BY id DESC LIMIT 1").fetchone()
+    connection.close()
+    assert textout == forms.escape(document) == "a &lt;b&gt;dawg&lt;/b&gt; &amp; kewl\n" * 100000
+
+    flask_app.config['SPELLCHECK_MAX_INPUT_BYTES'] = 1024 * 1024
+    result = app.post('/spell_check', data = {'inputtext':"my dawg is kewl. " * 100000})
+    assert result.status_code == 413
+    # CSRF protection does not parse the oversized form first
+    flask_app.config['WTF_CSRF_ENABLED'] = True
+    assert app.post('/spell_check', data = {'inputtext':"my dawg is kewl. " * 100000}).status_code == 413
+    # A chunked body without a length is not read at all
+    flask_app.config['WTF_CSRF_ENABLED'] = False
+    body = ("inputtext=" + "kewl+" * 100000).encode()
+    result = app.post('/spell_check', input_stream = io.BytesIO(body), content_type = "application/x-www-form-urlencoded",
+                      headers = {'Transfer-Encoding': "chunked"}, environ_overrides = {'wsgi.input_terminated': True})
+    assert result.status_code == 411
+
+# Check that the streamed spell check form is still protected against CSRF
+def test_spellcheck_csrf(app):
+    app.post('/register', data = {'uname':"jonathan", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    app.post('/login', data = {'uname':"jonathan", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    app.application.config['WTF_CSRF_ENABLED'] = True
+    page = app.get('/spell_check').data.decode()
+    token = page.split('name="csrf_token" value="')[1].split('"')[0]
+    assert app.post('/spell_check', data = {'inputtext':"my dawg is kewl."}).status_code == 400
+    assert app.post('/spell_check', data = {'inputtext':"my dawg is kewl.", 'csrf_token':"forged"}).status_code == 400
+    result = app.post('/spell_check', data = {'inputtext':"my dawg is kewl.", 'csrf_token':token})
+    assert result.status_code == 200
+    assert b'<div id="misspelled" style = "color: black">dawg, kewl</div>' in result.data
+    # Multipart forms are parsed by Werkzeug and checked the same way
+    assert app.post('/spell_check', data = {'inputtext':"my dawg", 'csrf_token':token}, content_type = "multipart/form-data").status_code == 200
+    assert app.post('/spell_check', data = {'inputtext':"my dawg"}, content_type = "multipart/form-data").status_code == 400
+    assert app.post('/spell_check', data = {'csrf_token':token}).status_code == 400
+
+# Check that stored hashes move to a new work factor on login and that a full hashing queue returns 503
+def test_login_rehash(app):
+    flask_app = app.application
+    flask_app.config['BCRYPT_LOG_ROUNDS'] = 4
+    app.post('/register', data = {'uname':"jonathan", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    connection = connect(flask_app)
+    password, = connection.execute("SELECT password FROM user WHERE username = 'jonathan'").fetchone()
+    assert hashing.hash_rounds(password) == 4
+    flask_app.config['BCRYPT_LOG_ROUNDS'] = 5
+    result = app.post('/login', data = {'uname':"jonathan", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    assert b'<div id="result" style = "color: black">Success!</div>' in result.data
+    password, twofa = connection.execute("SELECT password, twofa FROM user WHERE username = 'jonathan'").fetchone()
+    connection.close()
+    assert hashing.hash_rounds(password) == 5
+    assert hashing.hash_rounds(twofa) == 5
+    app.get('/logout', follow_redirects=True)
+    result = app.post('/login', data = {'uname':"jonathan", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    assert b'<div id="result" style = "color: black">Success!</div>' in result.data
+    app.get('/logout', follow_redirects=True)
+
+    # Take every slot of the hashing pool
+    pool = flask_app.extensions['hashing_pool']
+    taken = 0
+    while pool.slots.acquire(blocking=False):
+        taken += 1
+    result = app.post('/login', data = {'uname':"jonathan", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    assert result.status_code == 503
+    for _ in range(taken):
+        pool.slots.release()
+
+# Check that history pages are split by query id and keep the total count
+def test_history_pages(app):
+    app.application.config['HISTORY_PAGE_SIZE'] = 2
+    app.post('/register', data = {'uname':"brian", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    app.post('/login', data = {'uname':"brian", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    app.post('/api/spell_check/batch', json = ["one", "two", "three", "four", "five"])
+    result = app.get('/history', follow_redirects=True)
+    assert b'<div id="numqueries">Total number of queries: 5</div>' in result.data
+    assert b'id="query2">2</a>' in result.data
+    assert b'id="query3">3</a>' not in result.data
+    assert b'href="/history?after=2" id="nextpage"' in result.data
+    result = app.get('/history?after=2', follow_redirects=True)
+    assert b'id="query2">2</a>' not in result.data
+    assert b'id="query4">4</a>' in result.data
+    result = app.get('/history?after=4', follow_redirects=True)
+    assert b'id="query5">5</a>' in result.data
+    assert b'id="nextpage"' not in result.data
+    # Check that the query page still loads the submitted text
+    result = app.get('/history/query3', follow_redirects=True)
+    assert b'<div id="querytext">Text Submitted: three</div>' in result.data
+    app.get('/logout', follow_redirects=True)
+
+    # Check that admin searches and log searches page the same way
+    app.post('/login', data = {'uname':"admin", 'pword':"Administrator@1", '2fa':"12345678901"}, follow_redirects=True)
+    result = app.post('/history', data = {'uname':"brian"}, follow_redirects=True)
+    assert b'<div id="numqueries">Total number of queries: 5</div>' in result.data
+    assert b'href="/history?uname=brian&amp;after=2" id="nextpage"' in result.data
+    result = app.get('/history?uname=brian&after=2', follow_redirects=True)
+    assert b'Showing results for: brian' in result.data
+    assert b'id="query3">3</a>' in result.data
+    for _ in range(2):
+        app.get('/logout', follow_redirects=True)
+        app.post('/login', data = {'uname':"admin", 'pword':"Administrator@1", '2fa':"12345678901"}, follow_redirects=True)
+    result = app.post('/login_history', data = {'uname':"admin"}, follow_redirects=True)
+    assert b'<div id="login3_time">' in result.data
+    assert b'<div id="login4_time">' not in result.data
+    result = app.get('/login_history?uname=admin&after=3', follow_redirects=True)
+    assert b'<div id="login4_time">' in result.data
+    assert b'<div id="login3_time">' not in result.data
+
+# Check that the session keeps the user id and role and that role changes apply once the identity is forgotten
+def test_session_identity(app):
+    app.post('/register', data = {'uname':"brian", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    app.post('/login', data = {'uname':"brian", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    with app.session_transaction() as sess:
+        assert (sess['uid'], sess['username'], sess['role']) == (2, "brian", "user")
+    result = app.get('/login_history', follow_redirects=True)
+    assert b'Home Page' in result.data
+    # Promote brian, the cached role is used until the identity is forgotten
+    connection = connect(app.application)
+    connection.execute("UPDATE user SET role = 'admin' WHERE id = 2")
+    connection.commit()
+    connection.close()
+    result = app.get('/', follow_redirects=True)
+    assert b'<a style = "color: white" href = "/login_history">LOGS</a>' not in result.data
+    app.application.extensions['identity_cache'].delete(2)
+    result = app.get('/', follow_redirects=True)
+    assert b'<a style = "color: white" href = "/login_history">LOGS</a>' in result.data
+    result = app.get('/login_history', follow_redirects=True)
+    assert b'<form name="userid" id="userid" action="/login_history" method="POST">' in result.data
+    # The history search goes by role as well, not by the name admin
+    result = app.get('/history', follow_redirects=True)
+    assert b'<form name="userquery" id="userquery" action="/history" method="POST">' in result.data
+    app.get('/logout', follow_redirects=True)
+    with app.session_transaction() as sess:
+        assert 'uid' not in sess and 'role' not in sess
+
+    # Check that sessions holding only a username still work
+    with app.session_transaction() as sess:
+        sess['username'] = "admin"
+    result = app.get('/login_history', follow_redirects=True)
+    assert b'<form name="userid" id="userid" action="/login_history" method="POST">' in result.data
+    with app.session_transaction() as sess:
+        assert (sess['uid'], sess['role']) == (1, "admin")
+
+# Check that queries and logs written behind the request are batched, read back and flushed on close
+def test_write_behind(tmpdir):
+    path = tmpdir.join("spellchecker.db")
+    flask_app = create_app(dict(TEST_CONFIG, DB_WRITE_BEHIND = True, DB_WRITE_INTERVAL = 0.5, WTF_CSRF_ENABLED = False, **database(path)))
+    app = flask_app.test_client()
+    app.post('/register', data = {'uname':"brian", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    app.post('/login', data = {'uname':"brian", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    for i in range(5):
+        app.post('/spell_check', data = {'inputtext':"my dawg number%d" % i}, follow_redirects=True)
+    # History waits for the queued rows
+    result = app.get('/history', follow_redirects=True)
+    assert b'<div id="numqueries">Total number of queries: 5</div>' in result.data
+    result = app.get('/logout', follow_redirects=True)
+    with app.session_transaction() as sess:
+        assert 'username' not in sess
+    app.post('/login', data = {'uname':"brian", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    app.post('/spell_check', data = {'inputtext':"my dawg is kewl"}, follow_redirects=True)
+    # Pages are not rendered from stale rows when the writer falls behind
+    write_queue = flask_app.extensions['write_queue']
+    write_queue.flush = lambda timeout=None: False
+    assert app.get('/history').status_code == 503
+    del write_queue.flush
+    write_queue.close()
+    connection = sqlite3.connect(str(path))
+    assert connection.execute("SELECT COUNT(*) FROM query").fetchone()[0] == 6
+    assert connection.execute("SELECT COUNT(*) FROM log WHERE logout IS NOT NULL").fetchone()[0] == 1
+    assert connection.execute("SELECT COUNT(*) FROM log").fetchone()[0] == 2
+    connection.close()
+
+# Check that the production profile pools connections, tunes SQLite and honours DATABASE_URL
+def test_production_profile(tmpdir, monkeypatch):
+    path = str(tmpdir.join("production.db"))
+    monkeypatch.setenv("DATABASE_URL", "sqlite:///" + path)
+    flask_app = create_app(TEST_CONFIG, profile='production')
+    assert flask_app.config['SQLALCHEMY_DATABASE_URI'] == "sqlite:///" + path
+    assert not flask_app.config['SQLALCHEMY_TRACK_MODIFICATIONS']
+    # The schema is created by the init command instead of at startup
+    assert not os.path.exists(path)
+    assert "Initialized the database" in flask_app.test_cli_runner().invoke(args=['init-db']).output
+    app = flask_app.test_client()
+    flask_app.config['WTF_CSRF_ENABLED'] = False
+    app.post('/register', data = {'uname':"brian", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    app.post('/login', data = {'uname':"brian", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        statuses = list(executor.map(lambda i: app.post('/spell_check', data = {'inputtext':"my dawg %d" % i}).status_code, range(20)))
+    assert statuses == [200] * 20
+    engine = flask_app.extensions['sqlalchemy'].db.engine
+    assert engine.pool.size() == 10
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert connection.exec_driver_sql("PRAGMA synchronous").scalar() == 1
+        assert connection.exec_driver_sql("SELECT COUNT(*) FROM query").scalar() == 20
+    with pytest.raises(ValueError):
+        create_app(profile='staging')
+
+# Check that request, stage and query metrics are served to admins only and that profiling can be turned on at runtime
+def test_metrics(app, tmpdir):
+    flask_app = app.application
+    flask_app.config['SPELLCHECK_BACKEND'] = 'binary'
+    app.post('/register', data = {'uname':"brian", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    app.post('/login', data = {'uname':"brian", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    app.post('/spell_check', data = {'inputtext':"my dawg is kewl."}, follow_redirects=True)
+    assert app.get('/metrics').status_code == 403
+    assert app.post('/metrics/profile', data = {'enabled':"1"}).status_code == 403
+    app.get('/logout', follow_redirects=True)
+    app.post('/login', data = {'uname':"admin", 'pword':"Administrator@1", '2fa':"12345678901"}, follow_redirects=True)
+    result = app.get('/metrics')
+    assert result.status_code == 200
+    assert result.content_type.startswith('text/plain')
+    for line in [b'http_requests_total{method="POST",route="/spell_check",status="200"} 1',
+                 b'stage_duration_seconds_count{stage="bleach"}', b'stage_duration_seconds_count{stage="escape"} 1',
+                 b'stage_duration_seconds_count{stage="bcrypt"}',
+                 b'stage_duration_seconds_count{stage="checker_input"} 1', b'stage_duration_seconds_count{stage="checker_binary"} 1',
+                 b'stage_duration_seconds_count{stage="db_write"}', b'stage_duration_seconds_count{stage="template"}',
+                 b'db_query_duration_seconds_count{statement="SELECT"}', b'http_request_duration_seconds_bucket{',
+                 b'spellcheck_cache_misses 1']:
+        assert line in result.data
+
+    # Every profiled request is slower than a zero threshold
+    flask_app.extensions['profiler'].directory = str(tmpdir.join("profiles"))
+    settings = app.post('/metrics/profile', data = {'enabled':"1", 'threshold':"0"}).get_json()
+    assert settings['enabled'] and settings['threshold'] == 0
+    # Bad numbers are refused without changing anything, the sample rate is kept within [0, 1]
+    assert app.post('/metrics/profile', data = {'enabled':"0", 'threshold':"fast"}).status_code == 400
+    assert app.post('/metrics/profile', data = {'sample_rate':"nan"}).status_code == 400
+    assert app.post('/metrics/profile', data = {'sample_rate':"5"}).get_json()['sample_rate'] == 1
+    assert app.post('/metrics/profile', data = {'sample_rate':"-1"}).get_json()['sample_rate'] == 0
+    settings = app.post('/metrics/profile', data = {'sample_rate':"1"}).get_json()
+    assert settings['enabled'] and settings['threshold'] == 0
+    app.get('/history')
+    assert app.post('/metrics/profile', data = {'enabled':"0"}).get_json()['saved'] >= 1
+    assert any(name.startswith("history-") for name in os.listdir(str(tmpdir.join("profiles"))))
+
+# Check that requests can pick one of several dictionaries and that queries record it
+def test_spellcheck_dictionaries(tmpdir):
+    pirate = tmpdir.join("pirate.txt")
+    pirate.write("arrr\nmy\nis\n")
+    flask_app = create_app(dict(TEST_CONFIG, WTF_CSRF_ENABLED = False, SPELLCHECK_DICTIONARIES = {'pirate': str(pirate)},
+                                SQLALCHEMY_DATABASE_URI = 'sqlite://'))
+    app = flask_app.test_client()
+    app.post('/register', data = {'uname':"brian", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    app.post('/login', data = {'uname':"brian", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    result = app.get('/spell_check')
+    assert b'<option value="pirate">pirate</option>' in result.data
+    result = app.post('/spell_check', data = {'inputtext':"arrr my dawg", 'dictionary':"pirate"}, follow_redirects=True)
+    assert b'<div id="misspelled" style = "color: black">dawg</div>' in result.data
+    result = app.post('/spell_check', data = {'inputtext':"arrr my dawg"}, follow_redirects=True)
+    assert b'<div id="misspelled" style = "color: black">arrr, dawg</div>' in result.data
+    result = app.post('/api/spell_check/batch?dictionary=pirate', json = ["arrr is kewl"])
+    assert result.get_json() == {"results": [["kewl"]]}
+    assert app.post('/spell_check', data = {'inputtext':"arrr", 'dictionary':"klingon"}).status_code == 400
+    assert app.post('/api/spell_check/batch?dictionary=klingon', json = ["arrr"]).status_code == 400
+    registry = flask_app.extensions['dictionaries']
+    connection = connect(flask_app)
+    rows = connection.execute("SELECT dictionary, dictionary_version FROM query ORDER BY id").fetchall()
+    connection.close()
+    assert rows == [("pirate", registry.get("pirate").dictionary.version), ("default", registry.get("default").dictionary.version),
+                    ("pirate", registry.get("pirate").dictionary.version)]
+    result = app.get('/history/query1', follow_redirects=True)
+    assert b'<div id="querydictionary">Dictionary: pirate</div>' in result.data
+
+# Check importing users from the command line and the admin endpoint, and streaming exports
+def test_bulk_users(app, tmpdir):
+    flask_app = app.application
+    flask_app.config['IMPORT_BATCH_SIZE'] = 2
+    users = tmpdir.join("users.csv")
+    users.write("username,password,twofa\nbrian,password,6316827788\ncarol,secret,123\nbrian,again,1\nadmin,x,1\ndave,,1\n")
+    result = flask_app.test_cli_runner().invoke(args=['import-users', str(users)])
+    assert "Imported 2 users, skipped 3" in result.output
+    result = app.post('/login', data = {'uname':"carol", 'pword':"secret", '2fa':"123"}, follow_redirects=True)
+    assert b'Success!' in result.data
+    app.post('/spell_check', data = {'inputtext':"my dawg is kewl"}, follow_redirects=True)
+    body = '{"username": "erin", "password": "password", "twofa": "1"}\n{"username": "carol", "password": "x", "twofa": "1"}\n'
+    assert app.post('/admin/users/import', data = body).status_code == 403
+    assert app.get('/admin/export/queries').status_code == 403
+    app.get('/logout', follow_redirects=True)
+
+    app.post('/login', data = {'uname':"admin", 'pword':"Administrator@1", '2fa':"12345678901"}, follow_redirects=True)
+    result = app.post('/admin/users/import', data = body, content_type = "application/x-ndjson")
+    assert result.get_json() == {"imported": 1, "skipped": 1}
+    assert app.post('/admin/users/import?format=jsonl', data = "not json").status_code == 400
+    # A bad line stops the import, the response counts the rows before it that were committed
+    flask_app.config['IMPORT_BATCH_SIZE'] = 1
+    result = app.post('/admin/users/import?format=jsonl', data = '{"username": "frank", "password": "x", "twofa": "1"}\n[1, 2]\n{"username": "gina", "password": "x", "twofa": "1"}\n')
+    assert result.status_code == 400
+    assert result.get_json() == {"error": "Could not read the user list: line 2: expected a JSON object", "imported": 1, "skipped": 0}
+    lines = tmpdir.join("users.jsonl")
+    lines.write('{"username": "hank", "password": "x", "twofa": "1"}\n\n"ivan"\n')
+    result = flask_app.test_cli_runner().invoke(args=['import-users', str(lines)])
+    assert result.exit_code != 0 and "Imported 1 users, skipped 0" in result.output and "line 3" in result.output
+    app.post('/spell_check', data = {'inputtext':"arrr"}, follow_redirects=True)
+    result = app.get('/admin/export/queries')
+    assert result.mimetype == "text/csv"
+    assert result.headers['Content-Disposition'] == "attachment; filename=queries.csv"
+    assert result.data.decode().splitlines() == ["id,username,textout,misspelled,dictionary,dictionary_version",
+                                                 '1,carol,my dawg is kewl,"dawg, kewl",default,%s' % flask_app.extensions['dictionaries'].get('default').dictionary.version,
+                                                 '2,admin,arrr,arrr,default,%s' % flask_app.extensions['dictionaries'].get('default').dictionary.version]
+    result = app.get('/admin/export/logs?format=jsonl&uname=carol')
+    assert result.mimetype == "application/x-ndjson"
+    rows = [json.loads(line) for line in result.data.decode().splitlines()]
+    assert [(row['username'], row['logout'] is not None) for row in rows] == [("carol", True)]
+    assert app.get('/admin/export/logs?uname=nobody').status_code == 404
+    result = app.post('/login', data = {'uname':"erin", 'pword':"password", '2fa':"1"}, follow_redirects=True)
+    assert b'Already logged in!' in result.data
+    app.get('/logout', follow_redirects=True)
+    result = app.post('/login', data = {'uname':"erin", 'pword':"password", '2fa':"1"}, follow_redirects=True)
+    assert b'Success!' in result.data
+
+# Check the per user and per address rate limits and the cap on concurrent checks
+def test_rate_limits(app):
+    flask_app = app.application
+    flask_app.config['RATE_LIMITS'] = {'login': {'ip': (4, 60), 'user': (2, 60)}, 'spell_check': {'user': (1, 60)}}
+    app.post('/register', data = {'uname':"brian", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    for _ in range(2):
+        assert b'Incorrect username or password!' in app.post('/login', data = {'uname':"brian", 'pword':"wrong", '2fa':"6316827788"}).data
+    result = app.post('/login', data = {'uname':"brian", 'pword':"password", '2fa':"6316827788"})
+    assert result.status_code == 429
+    assert 1 <= int(result.headers['Retry-After']) <= 30
+    # Other users can still log in until the address runs out, rejected requests count too
+    assert b'Success!' in app.post('/login', data = {'uname':"admin", 'pword':"Administrator@1", '2fa':"12345678901"}).data
+    app.get('/logout')
+    assert app.post('/login', data = {'uname':"dave", 'pword':"x", '2fa':"1"}).status_code == 429
+    assert app.post('/login', data = {'uname':"dave", 'pword':"x", '2fa':"1"}, environ_base = {'REMOTE_ADDR': "10.0.0.2"}).status_code == 200
+    # GETs are never limited
+    assert app.get('/login').status_code == 200
+
+    other = flask_app.test_client()
+    other.post('/register', data = {'uname':"carol", 'pword':"password", '2fa':"6316827788"})
+    other.post('/login', data = {'uname':"carol", 'pword':"password", '2fa':"6316827788"}, environ_base = {'REMOTE_ADDR': "10.0.0.3"})
+    assert other.post('/spell_check', data = {'inputtext':"my dawg"}).status_code == 200
+    assert other.post('/spell_check', data = {'inputtext':"my dawg"}).status_code == 429
+    assert b'rate_limited_total{endpoint="spell_check",scope="user"} 1' in flask_app.extensions['metrics'].render().encode()
+
+    # A full check queue is turned away with a 503
+    flask_app.config['RATE_LIMITS'] = {}
+    check_limit = flask_app.extensions['check_limit']
+    check_limit.timeout = 0.05
+    for _ in range(flask_app.config['SPELLCHECK_MAX_CONCURRENT']):
+        check_limit.acquire()
+    result = other.post('/spell_check', data = {'inputtext':"my dawg"})
+    assert result.status_code == 503
+    assert check_limit.active == flask_app.config['SPELLCHECK_MAX_CONCURRENT']
+    for _ in range(flask_app.config['SPELLCHECK_MAX_CONCURRENT']):
+        check_limit.release()
+    assert other.post('/api/spell_check/batch', json = ["my dawg"]).status_code == 200
+    assert check_limit.active == 0
+
+# Check that static pages are cached per session state with ETags and that style.css is served with a content hash
+def test_page_cache(app):
+    flask_app = app.application
+    page_cache = flask_app.extensions['page_cache']
+    first = app.get('/')
+    second = app.get('/')
+    assert first.data == second.data and first.headers['ETag'] == second.headers['ETag']
+    assert 'no-cache' in first.headers['Cache-Control']
+    assert page_cache.hits == 1
+    result = app.get('/', headers = {'If-None-Match': first.headers['ETag']})
+    assert result.status_code == 304 and result.data == b""
+    assert result.headers['X-Content-Type-Options'] == "nosniff"
+
+    # Forms are cached once the session has a CSRF token and keep working
+    app.get('/register')
+    assert app.get('/register').data == app.get('/register').data
+    app.post('/register', data = {'uname':"brian", 'pword':"password", '2fa':"6316827788"})
+    flask_app.config['WTF_CSRF_ENABLED'] = True
+    login = app.get('/login')
+    token = login.data.split(b'name="csrf_token" value="')[1].split(b'"')[0].decode()
+    assert app.get('/login').headers['ETag'] == login.headers['ETag']
+    result = app.post('/login', data = {'uname':"brian", 'pword':"password", '2fa':"6316827788", 'csrf_token':token})
+    assert b'Success!' in result.data
+    # Logging in changes the page
+    result = app.get('/', headers = {'If-None-Match': first.headers['ETag']})
+    assert result.status_code == 200
+    assert b'href = "/spell_check">SPELL CHECK</a>' in result.data
+    assert app.get('/spell_check').headers['ETag'] == app.get('/spell_check').headers['ETag']
+    assert b'Already logged in!' in app.get('/login').data
+    # Another session gets its own form
+    other = flask_app.test_client()
+    other.get('/login')
+    assert other.get('/login').data != login.data
+
+    href = first.data.split(b'<link rel="stylesheet" type="text/css" href="')[1].split(b'"')[0].decode()
+    assert href.startswith("/static/style.css?v=")
+    result = app.get(href)
+    assert result.status_code == 200
+    assert "max-age=31536000" in result.headers['Cache-Control'] and "immutable" in result.headers['Cache-Control']
+    assert "immutable" not in app.get("/static/style.css?v=old").headers.get('Cache-Control', "")
+    result.close()
+
+# Check that re-checks of an edited text only check the changed lines and are stored as deltas
+def test_spellcheck_recheck(app):
+    flask_app = app.application
+    app.post('/register', data = {'uname':"brian", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    app.post('/login', data = {'uname':"brian", 'pword':"password", '2fa':"6316827788"}, follow_redirects=True)
+    lines = ["Line number %d is correct." % i for i in range(200)]
+    lines[10] = "my dawg is kewl"
+    original = "\n".join(lines)
+    app.post('/spell_check', data = {'inputtext':original}, follow_redirects=True)
+    lines[50] = "teh cat sat"
+    lines[10] = "my dog is kewl"
+    edited = "\n".join(lines)
+    result = app.post('/api/spell_check/recheck/1', json = {'text':edited})
+    assert result.status_code == 200
+    body = result.get_json()
+    assert (body['id'], body['parent'], body['misspelled'], body['checked_lines']) == (2, 1, ["kewl", "teh"], 2)
+    assert body['suggestions']['teh'][0] == "the"
+    # The same edit again comes from the cache
+    assert app.post('/api/spell_check/recheck/1', json = {'text':edited}).get_json()['checked_lines'] == 0
+    # Revisions chain, the text is rebuilt from the deltas
+    lines.append("a new laast line")
+    result = app.post('/api/spell_check/recheck/2', json = {'text':"\n".join(lines)})
+    assert result.get_json()['misspelled'] == ["kewl", "teh", "laast"]
+    connection = connect(flask_app)
+    rows = connection.execute("SELECT id, parent_id, length(textout), delta IS NOT NULL FROM query ORDER BY id").fetchall()
+    connection.close()
+    assert rows == [(1, None, len(original), 0), (2, 1, 0, 1), (3, 1, 0, 1), (4, 2, 0, 1)]
+    result = app.get('/history/query4')
+    assert ('<div id="querytext">Text Submitted: %s</div>' % "\n".join(lines)).encode() in result.data
+    assert b'<div id="queryparent">Revision of: <a href="/history/query2">Query 2</a></div>' in result.data
+
+    # Past the limit on deltas in a row the text is stored in full again
+    flask_app.config['SPELLCHECK_MAX_DELTAS'] = 1
+    app.post('/api/spell_check/recheck/4', json = {'text':edited})
+    connection = connect(flask_app)
+    assert connection.execute("SELECT parent_id, length(textout) FROM query WHERE id = 5").fetchone() == (4, len(edited))
+    # Results from another word list are not reused
+    connection.execute("UPDATE query SET dictionary_version = 'old' WHERE id = 5")
+    connection.commit()
+    connection.close()
+    assert app.post('/api/spell_check/recheck/5', json = {'text':"my dawg"}).get_json()['checked_lines'] == 1
+
+    assert app.post('/api/spell_check/recheck/1', json = ["text"]).status_code == 400
+    assert app.post('/api/spell_check/recheck/99', json = {'text':"my dawg"}).status_code == 404
+    app.get('/logout')
+    assert app.post('/api/spell_check/recheck/1', json = {'text':"my dawg"}).status_code == 401
+    # Other users cannot re-check someone else's query, exports rebuild the text
+    app.post('/login', data = {'uname':"admin", 'pword':"Administrator@1", '2fa':"12345678901"}, follow_redirects=True)
+    assert app.post('/api/spell_check/recheck/1', json = {'text':"my dawg"}).status_code == 404
+    rows = app.get('/admin/export/queries?format=jsonl').data.decode().splitlines()
+    assert json.loads(rows[3])['textout'] == "\n".join(lines)
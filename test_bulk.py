@@ -0,0 +1,25 @@
+import pytest
+import io
+import json
+import bulk
+
+# Check reading users from CSV and JSON lines
+def test_read_users():
+    source = io.StringIO("username,password,twofa\nbrian,password,6316827788\ncarol,,123\n")
+    assert list(bulk.read_users(source, 'csv')) == [("brian", "password", "6316827788"), ("carol", "", "123")]
+    source = io.StringIO('{"username": "brian", "password": "password", "twofa": 6316827788}\n\n{"username": "carol"}\n')
+    assert list(bulk.read_users(source, 'jsonl')) == [("brian", "password", "6316827788"), ("carol", "", "")]
+    with pytest.raises(ValueError):
+        list(bulk.read_users(io.StringIO("not json\n"), 'jsonl'))
+    with pytest.raises(ValueError, match="line 2: expected a JSON object"):
+        list(bulk.read_users(io.StringIO('{"username": "brian"}\n[1, 2]\n'), 'jsonl'))
+
+# Check that exports are written a row at a time
+def test_format_rows():
+    rows = [(1, "brian", "my dawg"), (2, "carol", 'say "hi", bye')]
+    chunks = list(bulk.format_rows(['id', 'username', 'textout'], iter(rows), 'csv'))
+    assert len(chunks) == 3
+    assert "".join(chunks) == 'id,username,textout\r\n1,brian,my dawg\r\n2,carol,"say ""hi"", bye"\r\n'
+    chunks = list(bulk.format_rows(['id', 'username', 'textout'], iter(rows), 'jsonl'))
+    assert [json.loads(chunk) for chunk in chunks] == [{"id": 1, "username": "brian", "textout": "my dawg"},
+                                                       {"id": 2, "username": "carol", "textout": 'say "hi", bye'}]
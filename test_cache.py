@@ -0,0 +1,44 @@
+import pytest
+import time
+import cache
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_cache(request, tmpdir):
+    def make(size, ttl):
+        if request.param == "sqlite":
+            return cache.SqliteResultCache(str(tmpdir.join("cache.db")), size, ttl)
+        return cache.ResultCache(size, ttl)
+    return make
+
+# Check that keys depend on both the text and the dictionary version
+def test_cache_key():
+    assert cache.cache_key("my dawg", "v1") == cache.cache_key("my dawg", "v1")
+    assert cache.cache_key("my dawg", "v1") != cache.cache_key("my dawg", "v2")
+    assert cache.cache_key("my dawg", "v1") != cache.cache_key("my dog", "v1")
+
+# Check hits, misses and least recently used eviction
+def test_cache_lru(make_cache):
+    results = make_cache(2, 3600)
+    assert results.get("a") is None
+    results.set("a", [["dawg"], {}])
+    results.set("b", [[], {}])
+    assert results.get("a") == [["dawg"], {}]
+    results.set("c", [["kewl"], {}])
+    assert results.get("b") is None
+    assert results.get("a") == [["dawg"], {}]
+    assert results.get("c") == [["kewl"], {}]
+    assert (results.hits, results.misses) == (3, 2)
+    assert len(results) == 2
+    results.delete("a")
+    assert results.get("a") is None
+    assert len(results) == 1
+    results.clear()
+    assert len(results) == 0
+
+# Check that entries expire
+def test_cache_ttl(make_cache):
+    results = make_cache(10, 0.05)
+    results.set("a", [["dawg"], {}])
+    assert results.get("a") == [["dawg"], {}]
+    time.sleep(0.1)
+    assert results.get("a") is None
@@ -0,0 +1,39 @@
+import pytest
+import os
+import dictionaries
+
+def make_registry(loads):
+    def load(wordlist, snapshot, suggestion_path):
+        loads.append(wordlist)
+        with open(wordlist) as fo:
+            return set(fo.read().split()), None
+    return dictionaries.DictionaryRegistry(load)
+
+# Check that word lists are loaded once, replaced when they change and dropped when removed
+def test_registry(tmpdir):
+    english = tmpdir.join("english.txt")
+    english.write("the\ndog\n")
+    pirate = tmpdir.join("pirate.txt")
+    pirate.write("arrr\nmatey\n")
+    sources = {"default": (str(english), None, None), "pirate": (str(pirate), None, None)}
+    loads = []
+    registry = make_registry(loads)
+    assert registry.update(sources) == []
+    assert registry.names() == ["default", "pirate"]
+    assert "arrr" in registry.get("pirate").dictionary
+    assert registry.get("klingon") is None
+    assert registry.update(sources) == []
+    assert len(loads) == 2
+
+    # A check holding the old entry keeps using it after the swap
+    old = registry.get("pirate")
+    pirate.write("arrr\nmatey\nyarr\n")
+    os.utime(str(pirate), ns=(old.stat[1] + 10 ** 9, old.stat[1] + 10 ** 9))
+    assert registry.update(sources) == ["pirate"]
+    assert "yarr" in registry.get("pirate").dictionary
+    assert "yarr" not in old.dictionary
+    assert len(loads) == 3
+
+    del sources["pirate"]
+    assert registry.update(sources) == ["pirate"]
+    assert registry.names() == ["default"]
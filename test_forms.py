@@ -0,0 +1,34 @@
+import pytest
+import io
+import bleach
+from urllib.parse import urlencode
+from werkzeug.urls import url_decode
+import forms
+
+def read_fields(body, chunk_size):
+    fields = {}
+    for number, name, text in forms.read_urlencoded(io.BytesIO(body), chunk_size):
+        fields.setdefault(number, [name, ''])[1] += text
+    return [tuple(field) for number, field in sorted(fields.items())]
+
+# Check that forms read a chunk at a time match Werkzeug's parser wherever the chunks are cut
+def test_read_urlencoded():
+    bodies = [urlencode({'csrf_token': "abc.def", 'inputtext': "my dawg\r\nis kewl & “café” 100%", 'dictionary': "pirate"}).encode(),
+              b"a=1&&b&c=%e2%82%ac+%41%4&d=%ZZ%&=x&e=\xff", b"", b"inputtext="]
+    for body in bodies:
+        expected = list(url_decode(body).items(multi=True))
+        for chunk_size in (1, 2, 3, 5, 64):
+            assert read_fields(body, chunk_size) == expected
+    with pytest.raises(ValueError):
+        list(forms.read_urlencoded(io.BytesIO(b"a" * 100), 8, max_name_length=50))
+
+# Check that escaping text in pieces gives what bleach gives for plain text
+def test_escaper():
+    text = "a\r\nb\rc\nd & e < f > g \"h\" 'i'\x00j\x01k\x0cl\tm\r"
+    expected = bleach.clean(text)
+    assert forms.escape(text) == expected
+    for size in (1, 2, 3):
+        escaper = forms.Escaper()
+        pieces = [escaper.escape(text[start:start + size]) for start in range(0, len(text), size)]
+        assert "".join(pieces) + escaper.escape("", final=True) == expected
+    assert forms.escape("<b>dawg</b>") == "&lt;b&gt;dawg&lt;/b&gt;"
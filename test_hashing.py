@@ -0,0 +1,38 @@
+import pytest
+import threading
+import bcrypt
+import hashing
+
+# Check hashing, checking and reading the work factor of a hash
+def test_hashing_pool():
+    pool = hashing.HashingPool(workers=2, max_queue=2)
+    hashed, other = pool.hashpw_many([b"password", b"6316827788"], rounds=4)
+    assert hashing.hash_rounds(hashed) == 4
+    assert hashing.hash_rounds(pool.hashpw(b"password", rounds=5).decode()) == 5
+    assert hashing.hash_rounds(b"not a hash") is None
+    assert pool.checkpw(b"password", hashed)
+    assert not pool.checkpw(b"passwrd", hashed)
+    assert bcrypt.checkpw(b"6316827788", other)
+    pool.shutdown()
+
+# Check that calls beyond the queue limit fail fast
+def test_hashing_pool_busy():
+    pool = hashing.HashingPool(workers=1, max_queue=1)
+    release = threading.Event()
+    blocked = [pool.submit(release.wait) for _ in range(2)]
+    with pytest.raises(hashing.HashingBusy):
+        pool.hashpw(b"password", rounds=4)
+    release.set()
+    for future in blocked:
+        future.result()
+    assert hashing.hash_rounds(pool.hashpw(b"password", rounds=4)) == 4
+    pool.shutdown()
+
+# Check that streamed hashing waits for slots instead of failing and keeps order
+def test_hashing_pool_stream():
+    pool = hashing.HashingPool(workers=2, max_queue=0)
+    passwords = [("password%d" % i).encode() for i in range(6)]
+    hashes = list(pool.hashpw_stream(passwords, rounds=4))
+    assert len(hashes) == 6
+    assert all(bcrypt.checkpw(password, hashed) for password, hashed in zip(passwords, hashes))
+    pool.shutdown()
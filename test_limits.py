@@ -0,0 +1,61 @@
+import pytest
+import threading
+import time
+import limits
+
+# Check that buckets allow a burst, then refill at the given rate
+def test_rate_limiter():
+    limiter = limits.RateLimiter(size=2)
+    for _ in range(3):
+        limiter.take("a", 3, 1)
+    with pytest.raises(limits.RateLimited) as error:
+        limiter.take("a", 3, 1)
+    assert 0 < error.value.retry_after <= 1
+    limiter.take("b", 1, 100)
+    time.sleep(0.02)
+    limiter.take("b", 1, 100)
+    # Only the most recently used buckets are kept
+    limiter.take("c", 1, 1)
+    assert len(limiter) == 2
+    limiter.take("a", 3, 1)
+
+# Check that the sqlite buckets are shared between limiters
+def test_sqlite_rate_limiter(tmpdir):
+    path = str(tmpdir.join("limits.db"))
+    first, second = limits.SqliteRateLimiter(path), limits.SqliteRateLimiter(path)
+    first.take("a", 2, 0.01)
+    second.take("a", 2, 0.01)
+    with pytest.raises(limits.RateLimited) as error:
+        first.take("a", 2, 0.01)
+    assert 0 < error.value.retry_after <= 100
+    second.take("b", 2, 0.01)
+    assert len(first) == 2
+    # Refilled buckets are pruned
+    first.prune_interval = 0
+    first.take("c", 1, 1000)
+    time.sleep(0.01)
+    first.take("d", 1, 1000)
+    assert len(first) == 3
+    first.clear()
+    assert len(second) == 0
+
+# Check that callers wait for a slot up to the timeout and beyond the queue fail fast
+def test_concurrency_limit():
+    limit = limits.ConcurrencyLimit(1, max_waiting=1, timeout=0.1)
+    limit.acquire()
+    assert limit.active == 1
+    with pytest.raises(limits.ConcurrencyBusy):
+        limit.acquire()
+    # A waiting caller gets the slot when it is released
+    acquired = threading.Event()
+    waiter = threading.Thread(target=lambda: (limit.acquire(), acquired.set()))
+    limit.timeout = 5
+    waiter.start()
+    time.sleep(0.05)
+    with pytest.raises(limits.ConcurrencyBusy):
+        limit.acquire()
+    limit.release()
+    waiter.join()
+    assert acquired.is_set() and limit.active == 1
+    limit.release()
+    assert limit.active == 0
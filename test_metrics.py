@@ -0,0 +1,45 @@
+import pytest
+import os
+import pstats
+import time
+import metrics
+
+# Check counters, histograms and gauges in the Prometheus text format
+def test_metrics_render():
+    registry = metrics.Metrics(buckets=(0.1, 1.0))
+    registry.describe('requests_total', "Requests")
+    registry.increment('requests_total', route="/", status=200)
+    registry.increment('requests_total', 2, route="/", status=200)
+    registry.observe('duration_seconds', 0.05, stage="bleach")
+    registry.observe('duration_seconds', 0.5, stage="bleach")
+    registry.observe('duration_seconds', 5, stage="bleach")
+    with registry.timer('duration_seconds', stage='say "hi"'):
+        pass
+    registry.gauge('queue_pending', lambda: 7)
+    lines = registry.render().splitlines()
+    assert '# HELP requests_total Requests' in lines
+    assert '# TYPE requests_total counter' in lines
+    assert 'requests_total{route="/",status="200"} 3' in lines
+    assert '# TYPE duration_seconds histogram' in lines
+    assert 'duration_seconds_bucket{stage="bleach",le="0.1"} 1' in lines
+    assert 'duration_seconds_bucket{stage="bleach",le="1.0"} 2' in lines
+    assert 'duration_seconds_bucket{stage="bleach",le="+Inf"} 3' in lines
+    assert 'duration_seconds_sum{stage="bleach"} 5.55' in lines
+    assert 'duration_seconds_count{stage="bleach"} 3' in lines
+    assert 'duration_seconds_count{stage="say \\"hi\\""} 1' in lines
+    assert 'queue_pending 7' in lines
+
+# Check that only slow profiled requests are saved
+def test_profiler(tmpdir):
+    profiler = metrics.Profiler(str(tmpdir.join("profiles")), threshold=0.05)
+    assert profiler.start() is None
+    profiler.enabled = True
+    profile = profiler.start()
+    assert profiler.stop(profile, 0.01, "fast") is None
+    profile = profiler.start()
+    time.sleep(0.06)
+    path = profiler.stop(profile, 0.06, "slow")
+    assert os.path.basename(path).startswith("slow-")
+    assert pstats.Stats(path).total_calls > 0
+    profiler.sample_rate = 0
+    assert profiler.start() is None
@@ -0,0 +1,60 @@
+import pytest
+import random
+import revisions
+import spellcheck
+
+DICTIONARY = spellcheck.Dictionary([b"my", b"dog", b"is", b"cool", b"the", b"cat"])
+
+# Check that deltas rebuild the new text, including edits at either end and empty texts
+@pytest.mark.parametrize("old, new", [
+    ("my dawg\nis kewl\n", "my dog\nis kewl\n"),
+    ("my dawg\nis kewl", "my dawg\nis kewl\nthe cat"),
+    ("my dawg\nis kewl", "is kewl"),
+    ("", "my dawg"),
+    ("my dawg", ""),
+    ("same\ntext", "same\ntext"),
+])
+def test_text_delta(old, new):
+    delta = revisions.text_delta(old, new)
+    assert revisions.apply_delta(old, delta) == new
+    if old == new:
+        assert delta == []
+
+# Check that deltas stay small for small edits to big texts
+def test_text_delta_compact():
+    rng = random.Random(9163)
+    lines = ["line %d with some words\n" % i for i in range(2000)]
+    old = "".join(lines)
+    lines[rng.randrange(len(lines))] = "an edited line\n"
+    new = "".join(lines)
+    delta = revisions.text_delta(old, new)
+    assert revisions.apply_delta(old, delta) == new
+    assert len(delta) == 1 and len(delta[0][2]) < 100
+
+# Check that re-checking gives the same result as a full check while only checking changed lines
+def test_recheck():
+    rng = random.Random(9163)
+    words = ["my", "dog", "dawg", "is", "cool", "kewl", "the", "cat", "kat", "42"]
+    for _ in range(50):
+        old_lines = [" ".join(rng.choice(words) for _ in range(rng.randrange(6))) for _ in range(rng.randrange(1, 12))]
+        new_lines = list(old_lines)
+        for _ in range(rng.randrange(4)):
+            position = rng.randrange(len(new_lines) + 1)
+            if rng.random() < 0.5 and position < len(new_lines):
+                del new_lines[position]
+            else:
+                new_lines.insert(position, " ".join(rng.choice(words) for _ in range(3)))
+        old, new = "\n".join(old_lines), "\n".join(new_lines)
+        checked = []
+
+        def check(text):
+            checked.append(text)
+            return spellcheck.check_text(text, DICTIONARY)
+
+        misspelled, lines = revisions.recheck(old, new, spellcheck.check_text(old, DICTIONARY), check)
+        assert misspelled == spellcheck.check_text(new, DICTIONARY)
+        assert len(checked) <= 1 and lines <= len(new_lines)
+    # An unchanged text needs no checking at all
+    assert revisions.recheck("my dawg", "my dawg", ["dawg"], None) == (["dawg"], 0)
+    # The limit applies as for a full check
+    assert revisions.recheck("dawg", "dawg kat kewl", ["dawg"], lambda text: spellcheck.check_text(text, DICTIONARY), limit=2)[0] == ["dawg", "kat"]
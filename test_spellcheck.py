@@ -0,0 +1,186 @@
+import pytest
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+import spellcheck
+import suggestions
+
+BINARY = "./a.out"
+WORDLIST = "wordlist.txt"
+
+@pytest.fixture(scope="module")
+def dictionary():
+    return spellcheck.Dictionary.load(WORDLIST)
+
+# Build a reproducible corpus mixing dictionary words, typos, case changes, punctuation and odd whitespace
+def make_corpus(count=50, seed=9163):
+    rng = random.Random(seed)
+    with open(WORDLIST) as fo:
+        words = fo.read().split()
+    extras = ["dawg", "kewl", "teh", "quiery", "123", "4th", "3.14", "--", "...", "e-mail", "it's",
+              "“quoted”", "café", "naïve", "tab\there", "cr\rlf", "ALLCAPS", "MiXeD"]
+    corpus = []
+    for _ in range(count):
+        tokens = []
+        for _ in range(rng.randint(0, 120)):
+            word = rng.choice(words) if rng.random() < 0.7 else rng.choice(extras)
+            roll = rng.random()
+            if roll < 0.1:
+                word = word.upper()
+            elif roll < 0.2:
+                word = word.capitalize()
+            elif roll < 0.3 and len(word) > 2:
+                position = rng.randrange(len(word))
+                word = word[:position] + rng.choice("aeiouxyz") + word[position + 1:]
+            if rng.random() < 0.2:
+                word = rng.choice("\"'([") + word + rng.choice(".,;:!?)]\"'")
+            tokens.append(word)
+            tokens.append(rng.choice([" ", " ", " ", "  ", "\n", "\r\n", "\t"]))
+        corpus.append("".join(tokens))
+    return corpus
+
+# Check that the in-process engine reproduces a.out exactly
+@pytest.mark.skipif(not os.access(BINARY, os.X_OK), reason="a.out is not available")
+def test_parity_with_binary(dictionary):
+    for text in make_corpus():
+        expected = spellcheck.check_text_binary(text, BINARY, WORDLIST)
+        assert spellcheck.check_text(text, dictionary) == expected
+
+# Check the tokenizer and case rules on known inputs
+def test_check_text(dictionary):
+    assert spellcheck.check_text("my dawg is kewl.", dictionary) == ["dawg", "kewl"]
+    assert spellcheck.check_text("The THE the 12345 ...", dictionary) == []
+    assert spellcheck.check_text("Dawg\n(dawg) “dawg”", dictionary) == ["Dawg", "dawg"]
+    assert spellcheck.check_text("", dictionary) == []
+    assert len(spellcheck.check_text("qqq " * 2000, dictionary)) == spellcheck.MAX_MISSPELLED
+
+# Check that the worker pool answers like the engine and survives crashed and hung workers
+def test_worker_pool(dictionary):
+    pool = spellcheck.WorkerPool(spellcheck.worker_command(WORDLIST), size=2, timeout=5, health_interval=0)
+    try:
+        for text in make_corpus(count=10):
+            assert pool.check_text(text) == spellcheck.check_text(text, dictionary)
+        # Kill every worker, the next requests should transparently restart them
+        for worker in list(pool.workers.queue):
+            worker.process.kill()
+            worker.process.wait()
+        assert pool.check_text("my dawg is kewl.") == ["dawg", "kewl"]
+        pool.health_check()
+        assert all(worker.alive() for worker in pool.workers.queue)
+    finally:
+        pool.close()
+
+    # A worker that never answers should time out instead of blocking the request
+    pool = spellcheck.WorkerPool([sys.executable, "-c", "import time; time.sleep(60)"], size=1, timeout=0.5, health_interval=0)
+    try:
+        with pytest.raises(spellcheck.CheckerError):
+            pool.check_text("my dawg is kewl.")
+        assert pool.workers.qsize() == 1
+    finally:
+        pool.close()
+
+# Check that a health check stuck on a hung worker leaves the other workers to requests
+def test_worker_pool_health_check():
+    pool = spellcheck.WorkerPool(spellcheck.worker_command(WORDLIST), size=2, timeout=2, health_interval=0)
+    try:
+        # Swap the next worker a request would get for one that never answers
+        hung = spellcheck.Worker([sys.executable, "-c", "import time; time.sleep(60)"])
+        pool.workers.queue[-1].close()
+        pool.workers.queue[-1] = hung
+        checker = threading.Thread(target=pool.health_check)
+        checker.start()
+        # Wait until the health check is stuck pinging the hung worker
+        while hung in pool.workers.queue:
+            time.sleep(0.01)
+        start = time.monotonic()
+        assert pool.check_text("my dawg is kewl.") == ["dawg", "kewl"]
+        assert time.monotonic() - start < 1
+        checker.join()
+        assert pool.workers.qsize() == 2
+        assert hung not in pool.workers.queue and not hung.alive()
+        assert all(worker.ping(2) for worker in pool.workers.queue)
+    finally:
+        pool.close()
+
+# Check edit distances and suggestion ranking
+def test_suggestions(dictionary, tmpdir):
+    assert suggestions.edit_distance("teh", "the", 2) == 1
+    assert suggestions.edit_distance("kitten", "sitting", 3) == 3
+    assert suggestions.edit_distance("kitten", "sitting", 2) == 3
+    path = str(tmpdir.join("wordlist.suggest"))
+    index = suggestions.SuggestionIndex.load(path, dictionary)
+    assert index.suggest("teh")[0] == "the"
+    assert index.suggest("recieve")[0] == "receive"
+    assert index.suggest("acommodation", 1) == ["accommodation"]
+    assert index.suggest("") == []
+    # Check that the saved index is reused, and rebuilt for other settings
+    built = os.stat(path).st_mtime_ns
+    assert suggestions.SuggestionIndex.load(path, dictionary).suggest("teh") == index.suggest("teh")
+    assert os.stat(path).st_mtime_ns == built
+    small = suggestions.SuggestionIndex.load(path, dictionary, max_distance=1)
+    assert small.max_distance == 1
+    assert small.suggest("acommodation") == ["accommodation"]
+    # A file that is not an index is rebuilt rather than read
+    with open(path, "wb") as fo:
+        fo.write(b"garbage")
+    assert suggestions.SuggestionIndex.load(path, dictionary).suggest("teh")[0] == "the"
+
+# Check that the index is only built on the first suggestion and follows word list changes
+def test_lazy_suggestion_index(tmpdir):
+    path = str(tmpdir.join("small.suggest"))
+    lazy = suggestions.LazySuggestionIndex(path, spellcheck.Dictionary([b"the", b"cat"], version="a"))
+    assert not os.path.exists(path)
+    assert lazy.suggest("cta") == ["cat"]
+    assert os.path.exists(path)
+    changed = suggestions.LazySuggestionIndex(path, spellcheck.Dictionary([b"the", b"dog"], version="b"))
+    assert changed.suggest("dgo") == ["dog"]
+    assert changed.suggest("cta") == []
+
+# Check that the memory mapped snapshot matches the word list and is rebuilt when it changes
+def test_dictionary_snapshot(dictionary, tmpdir):
+    wordlist = str(tmpdir.join("wordlist.txt"))
+    snapshot = str(tmpdir.join("wordlist.snapshot"))
+    with open(WORDLIST, "rb") as source, open(wordlist, "wb") as target:
+        target.write(source.read())
+    mapped = spellcheck.load_dictionary(wordlist, snapshot)
+    assert isinstance(mapped, spellcheck.MappedDictionary)
+    assert len(mapped) == len(dictionary)
+    assert set(mapped) == set(dictionary)
+    assert mapped.version == dictionary.version
+    for text in make_corpus(count=10):
+        assert spellcheck.check_text(text, mapped) == spellcheck.check_text(text, dictionary)
+
+    # Touching the word list keeps the snapshot, changing it rebuilds the snapshot
+    built = os.stat(snapshot).st_mtime_ns
+    os.utime(wordlist, ns=(built + 10 ** 9, built + 10 ** 9))
+    assert spellcheck.load_dictionary(wordlist, snapshot).version == dictionary.version
+    assert os.stat(snapshot).st_mtime_ns == built
+    with open(wordlist, "ab") as fo:
+        fo.write(b"dawg\n")
+    changed = spellcheck.load_dictionary(wordlist, snapshot)
+    assert changed.version != dictionary.version
+    assert spellcheck.check_text("my dawg is kewl.", changed) == ["kewl"]
+
+# Check that tokenizing a stream gives the same tokens wherever the chunks are cut
+def test_tokenize_chunks():
+    documents = make_corpus(count=10) + ["ab\x00cd ef\ngh ij\x00 kl mn\nop", "   \n\n  x\x00y\x00z\nw  "]
+    for document in documents:
+        data = document.encode("utf-8")
+        expected = list(spellcheck.tokenize(data))
+        for size in (1, 2, 3, 7, 64):
+            chunks = (data[start:start + size] for start in range(0, len(data), size))
+            assert list(spellcheck.tokenize(chunks)) == expected
+
+# Check that large documents are checked in bounded memory
+def test_check_large_text(dictionary):
+    text = "the quick brown fox. " * 200000 + "my dawg is kewl."
+    tracemalloc.start()
+    misspelled = spellcheck.check_text(text, dictionary)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert misspelled == ["dawg", "kewl"]
+    # Only a few chunks of the 4 MB input are held at once
+    assert peak < 1024 * 1024
@@ -0,0 +1,82 @@
+import pytest
+import threading
+import time
+import writer
+
+# Check that queued rows are written in batches and flushed on close
+def test_write_behind_batches():
+    batches = []
+    rows = writer.WriteBehindQueue(batches.append, batch_size=10, interval=0.2)
+    rows.put_many(range(25))
+    assert rows.flush(5)
+    assert [row for batch in batches for row in batch] == list(range(25))
+    assert len(batches) < 25
+    assert max(len(batch) for batch in batches) <= 10
+    rows.put(25)
+    rows.close()
+    assert batches[-1][-1] == 25
+    with pytest.raises(writer.WriterBusy):
+        rows.put(26)
+
+# Check that a full queue fails after the timeout and that write errors do not stop the writer
+def test_write_behind_busy():
+    release = threading.Event()
+    written = []
+
+    def write(batch):
+        release.wait()
+        if batch == ["bad"]:
+            raise ValueError("bad row")
+        written.extend(batch)
+
+    rows = writer.WriteBehindQueue(write, max_size=1, batch_size=1, interval=0, timeout=0.1)
+    rows.put("bad")
+    # Wait until the writer holds the first row, then fill the queue
+    while rows.rows.qsize():
+        pass
+    rows.put("a")
+    with pytest.raises(writer.WriterBusy):
+        rows.put("b")
+    release.set()
+    assert rows.flush(5)
+    assert written == ["a"]
+    rows.close()
+
+# Check that a flush only waits for the rows queued before it, even while more keep coming
+def test_write_behind_flush_steady():
+    written = []
+    rows = writer.WriteBehindQueue(written.extend, batch_size=10, interval=0.01)
+    stop = threading.Event()
+
+    def produce():
+        number = 0
+        while not stop.is_set():
+            rows.put(number)
+            number += 1
+            time.sleep(0.001)
+
+    producer = threading.Thread(target=produce)
+    producer.start()
+    try:
+        for _ in range(3):
+            time.sleep(0.05)
+            start = time.monotonic()
+            target = rows.queued
+            assert rows.flush(5)
+            assert len(written) >= target
+            assert time.monotonic() - start < 1
+    finally:
+        stop.set()
+        producer.join()
+    rows.close()
+    assert written == list(range(len(written))) and rows.pending == 0
+
+# Check that a flush gives up after its timeout while the writer is stuck
+def test_write_behind_flush_timeout():
+    release = threading.Event()
+    rows = writer.WriteBehindQueue(lambda batch: release.wait(), interval=0)
+    rows.put("a")
+    assert not rows.flush(0.1)
+    release.set()
+    assert rows.flush(5)
+    rows.close()
@@ -0,0 +1,109 @@
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class WriterBusy(Exception):
+    pass
+
+
+class WriteBehindQueue(object):
+    # Collects rows queued by requests and hands them to write in batches from
+    # one background thread, so requests do not wait for the database commit.
+    # A batch is written once batch_size rows are waiting or interval seconds
+    # after its first row. At most max_size rows wait at once, put blocks for
+    # up to timeout seconds for room and then raises WriterBusy.
+    def __init__(self, write, max_size=10000, batch_size=500, interval=0.05, timeout=5):
+        self.write = write
+        self.rows = queue.Queue(max_size)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.timeout = timeout
+        # Rows are numbered in queue order and written in that order, so a
+        # flush only waits for the written count to reach the rows queued
+        # before it, not for the queue to run empty
+        self.put_lock = threading.Lock()
+        self.queued = 0
+        self.written = 0
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self.thread.start()
+
+    @property
+    def pending(self):
+        return self.queued - self.written
+
+    def put(self, row):
+        if self.closed:
+            raise WriterBusy()
+        with self.put_lock:
+            try:
+                self.rows.put(row, timeout=self.timeout)
+            except queue.Full:
+                raise WriterBusy()
+            self.queued += 1
+
+    def put_many(self, rows):
+        for row in rows:
+            self.put(row)
+
+    def flush(self, timeout=None):
+        # Wait until every row queued so far has been written, rows queued
+        # meanwhile are not waited for. Returns False on timeout.
+        target = self.queued
+        with self.condition:
+            return self.condition.wait_for(lambda: self.written >= target, timeout)
+
+    def close(self, timeout=30):
+        if self.closed:
+            return
+        self.closed = True
+        self.rows.put(None)
+        self.thread.join(timeout)
+
+    def _done(self, count):
+        with self.condition:
+            self.written += count
+            self.condition.notify_all()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            row = self.rows.get()
+            if row is None:
+                break
+            batch = [row]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    row = self.rows.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if row is None:
+                    stopping = True
+                    break
+                batch.append(row)
+            self._write(batch)
+        # Write whatever was queued before close
+        batch = []
+        while True:
+            try:
+                row = self.rows.get_nowait()
+            except queue.Empty:
+                break
+            if row is not None:
+                batch.append(row)
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            self.write(batch)
+        except Exception:
+            logger.exception("Could not write %d queued rows", len(batch))
+        finally:
+            self._done(len(batch))